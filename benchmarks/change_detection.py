@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+"""Compare fingerprint change detection against the old compare_prefixes path.
+
+Replays a recorded `gobgp monitor global rib -j` stream, pairing each update
+with the previous version of its prefix, and times both ways of deciding
+whether the route changed.
+
+    python3 benchmarks/change_detection.py [log/sample_data.log] [--repeat 20]
+"""
+import os
+import sys
+import argparse
+import timeit
+from copy import copy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gobgp_to_mongo  # noqa: E402
+from rib_shadow import route_fingerprint  # noqa: E402
+
+
+def compare_prefixes(new, old):
+    """The pre-fingerprint comparison, kept here as the baseline."""
+    new['history'] = new['age'] = new['active'] = None
+    old['history'] = old['age'] = old['active'] = None
+    if new == old:
+        return True
+    else:
+        return False
+
+
+def load_pairs(path):
+    """Return (new, previous) prefix pairs for every update of an already seen prefix."""
+    latest = {}
+    pairs = []
+    with open(path) as stream:
+        for line in stream:
+            update_entry = gobgp_to_mongo.get_update_entry(line)
+            if not update_entry:
+                continue
+            prefix = gobgp_to_mongo.build_json(update_entry)
+            if prefix['_id'] in latest:
+                pairs.append((prefix, latest[prefix['_id']]))
+            latest[prefix['_id']] = prefix
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', nargs='?',
+                        default=os.path.join(os.path.dirname(__file__), '..', 'log', 'sample_data.log'))
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    pairs = load_pairs(args.path)
+    if not pairs:
+        sys.exit(f'{args.path} has no repeated prefixes to compare')
+
+    def old_path():
+        for new, old in pairs:
+            compare_prefixes(copy(new), copy(old))
+
+    def fingerprint_compare():
+        for new, old in pairs:
+            new['fingerprint'] == old['fingerprint']
+
+    def fingerprint_build_and_compare():  # includes the hashing done once per update in build_json()
+        for new, old in pairs:
+            route_fingerprint(new) == old['fingerprint']
+
+    changed = sum(gobgp_to_mongo.update_prefix(new, old) is not None for new, old in pairs)
+    print(f'{len(pairs)} updates of known prefixes, {changed} with changed attributes')
+    for name, func in (('compare_prefixes', old_path),
+                       ('fingerprint', fingerprint_compare),
+                       ('fingerprint+hash', fingerprint_build_and_compare)):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f'{name:>16}: {best * 1e3:8.2f} ms  {best / len(pairs) * 1e9:8.0f} ns/update')
+
+
+if __name__ == '__main__':
+    main()
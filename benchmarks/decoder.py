@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+"""Compare the table-driven GoBGP decoder against the original if-chain.
+
+Decodes a recorded `gobgp monitor global rib -j` stream with both decoders,
+checks they agree, and reports lines per second.
+
+    python3 benchmarks/decoder.py [log/bgp.dump.json] [--repeat 5]
+"""
+import os
+import sys
+import argparse
+import ipaddress
+import json
+import logging
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bgp_attributes as BGP  # noqa: E402
+import gobgp_to_mongo  # noqa: E402
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'log')
+
+
+def legacy_get_update_entry(line):
+    try:
+        update_list = json.loads(line)
+        for update_entry in update_list:
+            if 'error' in update_entry:
+                return None
+            else:
+                return(update_entry)
+    except Exception as err:
+        logging.error("Error in get_update_entry(line):", err)
+        return None
+
+
+def legacy_community_32bit_to_string(number):
+    if number != 0:
+        return f'{int(bin(number)[:-16], 2)}:{int(bin(number)[-16:], 2)}'
+
+
+def legacy_build_json(update_entry):
+    """build_json() as it was before the dispatch table, kept as the baseline."""
+    update_json = {
+        '_id': update_entry['nlri']['prefix'],
+        'ip_version': ipaddress.ip_address(update_entry['nlri']['prefix'].split('/', 1)[0]).version,
+        'origin_asn': None,
+        'nexthop': None,
+        'nexthop_asn': None,
+        'as_path': [],
+        'med': 0,
+        'local_pref': 0,
+        'communities': [],
+        'route_origin': None,
+        'atomic_aggregate': None,
+        'aggregator_as': None,
+        'aggregator_address': None,
+        'originator_id': None,
+        'cluster_list': [],
+        'withdrawal': False,
+        'age': 0,
+        'active': True
+    }
+    for attribute in update_entry['attrs']:
+        if attribute['type'] == BGP.ORIGIN:
+            update_json['route_origin'] = BGP.ORIGIN_CODE[attribute['value']]
+        if attribute['type'] == BGP.AS_PATH:
+            try:
+                update_json['as_path'] = attribute['as_paths'][0]['asns']
+                update_json['nexthop_asn'] = update_json['as_path'][0]
+                update_json['origin_asn'] = update_json['as_path'][-1]
+            except Exception:
+                pass
+        if attribute['type'] == BGP.NEXT_HOP:
+            update_json['nexthop'] = attribute['nexthop']
+        if attribute['type'] == BGP.MULTI_EXIT_DISC:
+            try:
+                update_json['med'] = attribute['metric']
+            except Exception:
+                pass
+        if attribute['type'] == BGP.LOCAL_PREF:
+            try:
+                update_json['local_pref'] = attribute['value']
+            except Exception:
+                pass
+        if attribute['type'] == BGP.ATOMIC_AGGREGATE:
+            update_json['atomic_aggregate'] = True
+        if attribute['type'] == BGP.AGGREGATOR:
+            update_json['aggregator_as'] = attribute['as']
+            update_json['aggregator_address'] = attribute['address']
+        if attribute['type'] == BGP.COMMUNITY:
+            try:
+                for number in attribute['communities']:
+                    update_json['communities'].append(legacy_community_32bit_to_string(number))
+            except Exception:
+                pass
+        if attribute['type'] == BGP.ORIGINATOR_ID:
+            update_json['originator_id'] = attribute['value']
+        if attribute['type'] == BGP.CLUSTER_LIST:
+            update_json['cluster_list'] = attribute['value']
+        if attribute['type'] == BGP.MP_REACH_NLRI:
+            update_json['nexthop'] = attribute['nexthop']
+        if attribute['type'] == BGP.MP_UNREACH_NLRI:
+            pass
+        if attribute['type'] == BGP.EXTENDED_COMMUNITIES:
+            pass
+    if 'withdrawal' in update_entry:
+        update_json['withdrawal'] = update_entry['withdrawal']
+        update_json['active'] = False
+    if 'age' in update_entry:
+        update_json['age'] = datetime.fromtimestamp(update_entry['age']).strftime('%Y-%m-%d %H:%M:%S ') + 'UTC'
+    return update_json
+
+
+def legacy_decode(lines):
+    return [legacy_build_json(update_entry) for update_entry in map(legacy_get_update_entry, lines)
+            if update_entry]
+
+
+def default_path():
+    """The dev dump from gobgp/startup.sh if present, else the sample log."""
+    dump = os.path.join(LOG_DIR, 'bgp.dump.json')
+    return dump if os.path.exists(dump) else os.path.join(LOG_DIR, 'sample_data.log')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', nargs='?', default=default_path())
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.path) as stream:
+        lines = stream.readlines()
+    old = legacy_decode(lines)
+    new = gobgp_to_mongo.decode_lines(lines)[0]
+    mismatches = sum({key: value for key, value in new_prefix.items() if key != 'fingerprint'} != old_prefix
+                     for new_prefix, old_prefix in zip(new, old))
+    print(f'{args.path}: {len(lines)} lines, {len(new)} updates, {mismatches} decoded differently')
+    print(f'JSON backend: {gobgp_to_mongo.json_loads.__module__}')
+    for name, func in (('if-chain', lambda: legacy_decode(lines)),
+                       ('dispatch table', lambda: gobgp_to_mongo.decode_lines(lines))):  # includes fingerprinting
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f'{name:>14}: {len(lines) / best:10.0f} lines/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#! /usr/bin/env python3
+"""Replay GoBGP update streams through the gobgp_to_mongo pipeline.
+
+Streams are either recorded `gobgp monitor global rib -j` output (--replay)
+or generated for one of the SCENARIOS.  Each run reports updates per second,
+p50/p99 per-update latency (from the update reaching the writer to its batch
+being written) and Mongo operations issued per update.
+
+By default the writes go to stub collections that count them and store
+nothing, so the timings are those of the ingester itself: decoding, change
+detection, batching and building the writes.  With --mongo URI they include
+a real mongod.  --mongomock stores the routes in mongomock to check the
+queries, on smaller default tables; its upserts scan the whole collection,
+so its timings measure mongomock.
+
+    python3 benchmarks/ingest_replay.py full-table --ipv4 100000 --ipv6 20000
+    python3 benchmarks/ingest_replay.py flap-storm --mongo mongodb://localhost:27017
+    python3 benchmarks/ingest_replay.py --replay log/sample_data.log
+"""
+import os
+import sys
+import argparse
+import io
+import json
+import logging
+import random
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gobgp_to_mongo  # noqa: E402
+from rib_shadow import RibShadow  # noqa: E402
+
+PEERS = [(3356, '4.53.200.1'), (6939, '207.98.64.235'), (11164, '198.32.165.253'),
+         (174, '38.104.186.145'), (2914, '129.250.66.49'), (1299, '62.115.34.1')]
+COMMUNITIES = [242549116, 242549118, 242549130, 242549131, 242549140, 242549146]
+
+
+class CountingCollection(object):
+    """Proxy a collection, counting the calls that reach the server."""
+
+    COUNTED = frozenset(('find', 'find_one', 'bulk_write', 'insert_many', 'insert_one', 'update_one',
+                         'update_many', 'delete_many', 'find_one_and_update', 'aggregate', 'count_documents',
+                         'distinct'))
+
+    def __init__(self, collection, ops):
+        self._collection = collection
+        self._ops = ops
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in self.COUNTED:
+            def counted(*args, **kwargs):
+                self._ops[f'{self._collection.name}.{name}'] += 1
+                return attribute(*args, **kwargs)
+            return counted
+        return attribute
+
+
+class NullCollection(object):
+    """A collection that accepts the ingester's calls and stores nothing."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def find(self, *args, **kwargs):
+        return iter(())
+
+    def aggregate(self, *args, **kwargs):
+        return iter(())
+
+    def index_information(self):
+        return {}
+
+    def __getattr__(self, name):  # writes and index creation
+        return lambda *args, **kwargs: None
+
+
+class NullDatabase(object):
+    def __getattr__(self, name):
+        return NullCollection(name)
+
+
+class CountingDatabase(object):
+    def __init__(self, db):
+        self._db = db
+        self.ops = Counter()
+
+    def __getattr__(self, name):
+        return CountingCollection(getattr(self._db, name), self.ops)
+
+    __getitem__ = __getattr__
+
+
+class TimedBatchWriter(gobgp_to_mongo.BatchWriter):
+    """BatchWriter recording how long each update waits until it is written."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.enqueued = {}
+        self.latencies = []
+        self.flushing = []
+
+    def add(self, prefix_from_gobgp):
+        self.enqueued.setdefault(prefix_from_gobgp['_id'], []).append(time.perf_counter())
+        super().add(prefix_from_gobgp)
+
+    def ready(self, force=False):
+        self.flushing = super().ready(force)
+        return self.flushing
+
+    def flush(self, force=False):
+        super().flush(force)
+        now = time.perf_counter()
+        for _id in self.flushing:
+            self.latencies.extend(now - enqueued for enqueued in self.enqueued.pop(_id, ()))
+        self.flushing = []
+
+
+def update_line(prefix, peer, as_path, communities, age, withdrawal=False):
+    """Return one line of `gobgp monitor global rib -j` output."""
+    asn, nexthop = peer
+    attrs = [{'type': 1, 'value': 0},
+             {'type': 2, 'as_paths': [{'segment_type': 2, 'num': len(as_path) + 1, 'asns': [asn] + as_path}]},
+             {'type': 5, 'value': 1000},
+             {'type': 8, 'communities': communities},
+             {'type': 10, 'value': ['207.98.64.254']},
+             {'type': 9, 'value': '207.98.64.239'}]
+    if ':' in prefix:
+        attrs.insert(0, {'type': 14, 'nexthop': nexthop, 'afi': 2, 'safi': 1, 'value': [{'prefix': prefix}]})
+    else:
+        attrs.insert(2, {'type': 3, 'nexthop': nexthop})
+        attrs.insert(3, {'type': 4, 'metric': 0})
+    update = {'nlri': {'prefix': prefix}, 'attrs': attrs, 'age': age}
+    if withdrawal:
+        update['withdrawal'] = True
+    update['source-id'] = update['neighbor-ip'] = '207.98.64.254'
+    return json.dumps([update]) + '\n'
+
+
+def random_attributes(rng):
+    """Return random (peer, as_path, communities) for update_line()."""
+    as_path = [rng.randrange(1, 65000) for _ in range(rng.randrange(1, 6))]
+    return rng.choice(PEERS), as_path, rng.sample(COMMUNITIES, rng.randrange(0, 3))
+
+
+def random_route(rng, prefix, age):
+    return update_line(prefix, *random_attributes(rng), age)
+
+
+def table_prefixes(rng, ipv4, ipv6):
+    """Return *ipv4* + *ipv6* distinct prefixes with a realistic mask mix."""
+    prefixes = set()
+    while len(prefixes) < ipv4:
+        mask = rng.choice((24,) * 6 + (22, 23, 20, 19, 16))
+        address = rng.getrandbits(32) >> (32 - mask) << (32 - mask)
+        prefixes.add(f'{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}/{mask}')
+    v6 = set()
+    while len(v6) < ipv6:
+        mask = rng.choice((48,) * 4 + (32, 40, 44))
+        address = (0x2000 << 112 | rng.getrandbits(109) << 3) >> (128 - mask) << (128 - mask)
+        groups = [f'{address >> shift & 0xffff:x}' for shift in range(112, -16, -16)]
+        v6.add(':'.join(groups) + f'/{mask}')
+    return sorted(prefixes) + sorted(v6)
+
+
+def scenario_lines(name, rng, ipv4, ipv6, updates):
+    """Return (setup lines, measured lines) for scenario *name*."""
+    age = 1479496570
+    prefixes = table_prefixes(rng, ipv4, ipv6)
+    attributes = [random_attributes(rng) for _ in prefixes]
+    table = [update_line(prefix, *route, age) for prefix, route in zip(prefixes, attributes)]
+    if name == 'full-table':
+        return [], table
+    if name == 'churn':  # steady attribute changes across the table
+        return table, [random_route(rng, rng.choice(prefixes), age + i // 100) for i in range(updates)]
+    if name == 'flap-storm':  # a few percent of the table withdrawn and re-announced repeatedly
+        flapping = rng.sample(range(len(prefixes)), max(1, len(prefixes) // 50))
+        lines = []
+        for flap in range(max(1, updates // len(flapping))):
+            for position, index in enumerate(flapping):
+                # every round flips each prefix, half of them starting with a re-announce, so
+                # whatever the number of rounds, half the flapping prefixes end active
+                withdrawal = (flap + position) % 2 == 0
+                lines.append(update_line(prefixes[index], *attributes[index], age + len(lines) // 1000, withdrawal))
+        return table, lines
+    if name == 'mass-withdrawal':  # a peer session drop withdraws half the table
+        withdrawn = rng.sample(range(len(prefixes)), len(prefixes) // 2)
+        lines = []
+        for index in withdrawn:
+            update = json.loads(table[index])[0]
+            update['withdrawal'] = True
+            lines.append(json.dumps([update]) + '\n')
+        return table, lines
+    raise ValueError(name)
+
+
+SCENARIOS = ('full-table', 'churn', 'flap-storm', 'mass-withdrawal')
+
+
+def connect(uri, stub=False):
+    """Return the benchmark database on *uri*, else stub collections if
+    *stub*, else mongomock."""
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+    elif stub:
+        return NullDatabase()
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is not installed: pip install mongomock, or use --mongo URI')
+        client = mongomock.MongoClient()
+    client.drop_database('bgp_benchmark')
+    return client.bgp_benchmark
+
+
+def final_states(lines):
+    """Return {prefix: active} as of the last update of each prefix in *lines*."""
+    states = {}
+    for line in lines:
+        update_entry = gobgp_to_mongo.get_update_entry(line)
+        if update_entry:
+            prefix = gobgp_to_mongo.build_json(update_entry)
+            states[prefix['_id']] = prefix['active']
+    return states
+
+
+def run(db, lines, setup, args):
+    """Ingest *setup* untimed, then *lines* timed, and return the results.
+    Both share one generation so the measured run does not sweep the setup.
+    *active* is how many of the prefixes updated by *lines* end active, and
+    *mismatches* counts the prefixes whose written state (in the RIB shadow)
+    is not the announced or withdrawn state of their last update."""
+    rib = RibShadow()
+    gobgp_to_mongo.initialize_database(db)
+    if setup:
+        gobgp_to_mongo.ingest(db, rib, io.StringIO(''.join(setup)), 1, args.batch_size, args.flush_interval,
+                              args.workers, args.chunk_size, coalesce_window=args.coalesce_window)
+    counting = CountingDatabase(db)
+    writer = TimedBatchWriter(counting, rib, 1, args.batch_size, args.flush_interval, args.coalesce_window)
+    started = time.perf_counter()
+    gobgp_to_mongo.ingest(counting, rib, io.StringIO(''.join(lines)), 1, args.batch_size, args.flush_interval,
+                          args.workers, args.chunk_size, coalesce_window=args.coalesce_window, writer=writer)
+    elapsed = time.perf_counter() - started
+    latencies = sorted(writer.latencies)
+    expected = final_states(setup + lines)
+    measured = final_states(lines)
+    return {'updates': writer.metrics.counters['updates'],
+            'seconds': elapsed,
+            'p50': latencies[len(latencies) // 2] if latencies else 0,
+            'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0,
+            'ops': counting.ops,
+            'active': f'{sum(measured.values())}/{len(measured)}',  # of the prefixes the timed run updated
+            'mismatches': sum(1 for _id, active in expected.items() if rib.get(_id)['active'] != active)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenario', nargs='?', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--replay', help='recorded gobgp JSON stream to replay instead of a scenario')
+    parser.add_argument('--mongo', help='MongoDB URI (default: stub collections that store nothing)')
+    parser.add_argument('--mongomock', action='store_true', help='store the routes in mongomock, untimed')
+    parser.add_argument('--ipv4', type=int, help='IPv4 table size (default: 50000, 2000 with --mongomock)')
+    parser.add_argument('--ipv6', type=int, help='IPv6 table size (default: 10000, 500 with --mongomock)')
+    parser.add_argument('--updates', type=int,
+                        help='updates in churn and flap-storm runs (default: 50000, 2000 with --mongomock)')
+    parser.add_argument('--seed', type=int, default=179)
+    parser.add_argument('--batch-size', type=int, default=gobgp_to_mongo.BATCH_SIZE)
+    parser.add_argument('--flush-interval', type=float, default=gobgp_to_mongo.FLUSH_INTERVAL)
+    parser.add_argument('--coalesce-window', type=float, default=gobgp_to_mongo.COALESCE_WINDOW)
+    parser.add_argument('--workers', type=int, default=gobgp_to_mongo.WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=gobgp_to_mongo.CHUNK_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    mock = args.mongomock and not args.mongo
+    args.ipv4 = args.ipv4 if args.ipv4 is not None else 2000 if mock else 50000
+    args.ipv6 = args.ipv6 if args.ipv6 is not None else 500 if mock else 10000
+    args.updates = args.updates if args.updates is not None else 2000 if mock else 50000
+
+    if args.replay:
+        with open(args.replay) as stream:
+            runs = [(args.replay, [], stream.readlines())]
+    else:
+        names = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+        runs = [(name,) + tuple(scenario_lines(name, random.Random(args.seed), args.ipv4, args.ipv6, args.updates))
+                for name in names]
+
+    print(f'{"run":>16} {"updates":>9} {"updates/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"ops/update":>10} '
+          f'{"active":>13} {"mismatches":>10}')
+    for name, setup, lines in runs:
+        result = run(connect(args.mongo, stub=not args.mongomock), lines, setup, args)
+        ops = sum(result['ops'].values())
+        if mock:  # mongomock's timings say nothing about the ingester
+            timings = f'{"-":>10} {"-":>8} {"-":>8}'
+        else:
+            timings = f'{result["updates"] / result["seconds"]:10.0f} {result["p50"] * 1e3:8.1f} {result["p99"] * 1e3:8.1f}'
+        print(f'{name:>16} {result["updates"]:9d} {timings} {ops / max(result["updates"], 1):10.4f} '
+              f'{result["active"]:>13} {result["mismatches"]:10d}')
+        print(' ' * 17 + ', '.join(f'{op} {count}' for op, count in sorted(result['ops'].items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+"""Measure the memory and lookup latency of the Flask app's prefix index.
+
+Builds a radix.PrefixIndex from a synthetic full table, checks a sample of
+lookups against a brute-force longest-prefix match, and reports build time,
+memory, and lookups per second with p50/p99 latency for random addresses.
+
+    python3 benchmarks/radix_lookup.py --ipv4 950000 --ipv6 200000
+"""
+import os
+import sys
+import argparse
+import ipaddress
+import random
+import time
+import tracemalloc
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'flask', 'app'))
+from radix import PrefixIndex  # noqa: E402
+from ingest_replay import table_prefixes  # noqa: E402
+
+
+def random_address(rng, prefixes):
+    """Return an address inside a random table prefix (a likely hit), or a
+    random IPv4 address (a likely miss on small tables)."""
+    if rng.random() < 0.8:
+        network = ipaddress.ip_network(rng.choice(prefixes))
+        return str(network[rng.randrange(min(network.num_addresses, 2**32))])
+    return str(ipaddress.IPv4Address(rng.getrandbits(32)))
+
+
+def brute_force(networks, address):
+    address = ipaddress.ip_address(address)
+    matches = [network for network in networks if network.version == address.version and address in network]
+    return str(max(matches, key=lambda network: network.prefixlen)) if matches else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ipv4', type=int, default=950000, help='IPv4 table size (default: %(default)s)')
+    parser.add_argument('--ipv6', type=int, default=200000, help='IPv6 table size (default: %(default)s)')
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--check', type=int, default=200, help='lookups checked by brute force (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=179)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    prefixes = table_prefixes(rng, args.ipv4, args.ipv6)
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = PrefixIndex()
+    for prefix in prefixes:
+        index.add(prefix)
+    build = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0] + sum(map(sys.getsizeof, prefixes))  # the index holds the strings
+    tracemalloc.stop()
+    print(f'{len(index)} prefixes in {build:.1f}s, {memory / 2**20:.1f} MiB '
+          f'({memory / max(len(index), 1):.0f} bytes/prefix)')
+    print(f'mask lengths: {len(index.lengths[4])} IPv4, {len(index.lengths[6])} IPv6')
+
+    addresses = [random_address(rng, prefixes) for _ in range(args.lookups)]
+    if args.check:  # brute force is slow, so check an index of a subset of the table
+        networks = [ipaddress.ip_network(prefix) for prefix in rng.sample(prefixes, min(len(prefixes), 2000))]
+        networks += [network.supernet(new_prefix=max(network.prefixlen - 4, 0)) for network in networks[:200]]
+        subset = PrefixIndex()
+        for network in networks:
+            subset.add(str(network))
+        sample = [random_address(rng, [str(network) for network in networks]) for _ in range(args.check)]
+        wrong = sum(subset.lookup(address) != brute_force(networks, address) for address in sample)
+        print(f'checked {len(sample)} lookups against brute force on {len(networks)} overlapping prefixes: '
+              f'{"OK" if not wrong else f"{wrong} wrong"}')
+
+    latencies = []
+    lookup = index.lookup
+    for address in addresses:
+        started = time.perf_counter()
+        lookup(address)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    print(f'{len(addresses) / sum(latencies):.0f} lookups/s, p50 {latencies[len(latencies) // 2] * 1e6:.1f} us, '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f} us')
+
+
+if __name__ == '__main__':
+    main()
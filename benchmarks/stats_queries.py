@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+"""Count the queries and time the dashboard's peer and customer tables.
+
+Seeds a synthetic table, then builds the Stats.get_list_of() peer and
+customer lists three ways: the original per-ASN count queries, the
+aggregation pass over the bgp collection, and the ingester's bgp_counters.
+ASN names are counted, not resolved, so DNS does not skew the timings.
+
+    python3 benchmarks/stats_queries.py --ipv4 20000 --peers 50
+    python3 benchmarks/stats_queries.py --mongo mongodb://localhost:27017
+"""
+import os
+import sys
+import argparse
+import random
+import time
+from collections import Counter
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'flask', 'app'))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+import constants as C  # noqa: E402
+import Stats  # noqa: E402
+from ingest_replay import CountingDatabase, connect, table_prefixes  # noqa: E402
+from rib_shadow import RibShadow  # noqa: E402
+from route_counters import RouteCounters  # noqa: E402
+
+
+def legacy_get_list_of(db, customers=False, peers=False, community=C.CUSTOMER_BGP_COMMUNITY):
+    """Stats.get_list_of() as it was before the aggregation pass, with
+    cursor.count() spelled count_documents() for current pymongo."""
+    if peers:
+        query_results = {prefix['nexthop_asn'] for prefix in db.bgp.find({'active': True})}
+    if customers:
+        query_results = {prefix['nexthop_asn'] for prefix in db.bgp.find({'communities': community, 'active': True})}
+    return [{'asn': asn if asn is not None else C.DEFAULT_ASN,
+             'name': Stats.asn_name_query(asn),
+             'ipv4_origin_count': db.bgp.count_documents({'origin_asn': asn, 'ip_version': 4, 'active': True}),
+             'ipv6_origin_count': db.bgp.count_documents({'origin_asn': asn, 'ip_version': 6, 'active': True}),
+             'ipv4_nexthop_count': db.bgp.count_documents({'nexthop_asn': asn, 'ip_version': 4, 'active': True}),
+             'ipv6_nexthop_count': db.bgp.count_documents({'nexthop_asn': asn, 'ip_version': 6, 'active': True}),
+             'asn_count': len(db.bgp.distinct('as_path.1', {'nexthop_asn': asn, 'active': True}))}
+            for asn in query_results]
+
+
+def seed(db, rng, ipv4, ipv6, peers, customers):
+    """Insert a table whose routes are learned from *peers* next-hop ASNs,
+    the first *customers* of them tagged with the customer community."""
+    peer_asns = [rng.randrange(1000, 64000) for _ in range(peers)]
+    documents = []
+    for prefix in table_prefixes(rng, ipv4, ipv6):
+        index = min(int(rng.expovariate(5 / peers)), peers - 1)  # a few peers carry most of the table
+        as_path = [peer_asns[index]] + [rng.randrange(1, 65000) for _ in range(rng.randrange(0, 5))]
+        communities = [C.CUSTOMER_BGP_COMMUNITY] if index < customers else ['3701:380']
+        documents.append({'_id': prefix, 'ip_version': 6 if ':' in prefix else 4, 'origin_asn': as_path[-1],
+                          'nexthop': f'192.0.2.{index}', 'nexthop_asn': as_path[0], 'as_path': as_path,
+                          'med': 0, 'local_pref': 100, 'communities': communities, 'route_origin': 'IGP',
+                          'atomic_aggregate': None, 'aggregator_as': None, 'aggregator_address': None,
+                          'originator_id': None, 'cluster_list': [], 'withdrawal': False, 'age': 0,
+                          'active': rng.random() > 0.02, 'generation': 1})
+    db.bgp.insert_many(documents)
+    db.bgp.create_index([('origin_asn', 1), ('ip_version', 1), ('active', 1)])
+    db.bgp.create_index([('nexthop_asn', 1), ('active', 1)])
+    db.bgp.create_index([('communities', 1), ('active', 1)])
+
+
+def measure(name, func, counting, names):
+    counting.ops.clear()
+    names.clear()
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    queries = sum(counting.ops.values())
+    print(f'{name:>12} {queries:8d} {sum(names.values()):8d} {elapsed:9.3f}   '
+          + ', '.join(f'{op} {count}' for op, count in sorted(counting.ops.items())))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo', help='MongoDB URI (default: mongomock in memory)')
+    parser.add_argument('--ipv4', type=int, default=20000, help='IPv4 table size (default: %(default)s)')
+    parser.add_argument('--ipv6', type=int, default=4000, help='IPv6 table size (default: %(default)s)')
+    parser.add_argument('--peers', type=int, default=50, help='next-hop ASNs (default: %(default)s)')
+    parser.add_argument('--customers', type=int, default=10,
+                        help='peers tagged with the customer community (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=179)
+    args = parser.parse_args()
+
+    db = connect(args.mongo)
+    seed(db, random.Random(args.seed), args.ipv4, args.ipv6, args.peers, args.customers)
+    counting = CountingDatabase(db)
+    names = Counter()
+    Stats.asn_name_query = lambda asn: names.update((asn,)) or f'AS{asn}'
+    Stats.asn_names = lambda asns: {asn: Stats.asn_name_query(asn) for asn in set(asns)}
+    Stats.get_stats_db = lambda: counting
+    stats = Stats.Stats()
+
+    print(f'{"method":>12} {"queries":>8} {"names":>8} {"seconds":>9}')
+    legacy = measure('per-ASN', lambda: (legacy_get_list_of(counting, customers=True),
+                                         legacy_get_list_of(counting, peers=True)), counting, names)
+
+    def aggregated():
+        facets = stats.advanced_results()
+        return stats.get_list_of(customers=True, facets=facets), stats.get_list_of(peers=True, facets=facets)
+    new = measure('aggregation', aggregated, counting, names)
+
+    rib = RibShadow()
+    rib.load(db)
+    RouteCounters().reconcile(db, rib)
+    stats.use_counters = True
+    counters = measure('counters', aggregated, counting, names)
+
+    key = lambda row: row['asn']  # noqa: E731
+    for name, result in (('aggregation', new), ('counters', counters)):
+        same = all(sorted(a, key=key) == sorted(b, key=key) for a, b in zip(legacy, result))
+        print(f'{name} matches per-ASN: {same}')
+
+
+if __name__ == '__main__':
+    main()
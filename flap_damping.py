@@ -0,0 +1,64 @@
+import time
+
+# DEFAULTS - RFC 2439 figure of merit parameters
+HALF_LIFE = 900  # Seconds for a penalty to decay by half
+WITHDRAWAL_PENALTY = 1000  # Added when an announced route is withdrawn
+ATTRIBUTE_CHANGE_PENALTY = 500  # Added when an announced route changes attributes
+SUPPRESS_LIMIT = 2000  # A prefix above this penalty is marked damped
+REUSE_LIMIT = 750  # A damped prefix is released once its penalty decays below this
+MAX_SUPPRESS_TIME = 3600  # Seconds a damped prefix can take to decay to REUSE_LIMIT
+
+
+def decay(penalty, elapsed, half_life=HALF_LIFE):
+    """Return *penalty* after *elapsed* seconds of exponential decay."""
+    return penalty * 0.5 ** (elapsed / half_life)
+
+
+class FlapDamping(object):
+    """Per-prefix flap penalties as described in RFC 2439.  This is
+    bookkeeping only: damped prefixes are recorded, never suppressed.
+    Prefixes are tracked from their first flap until the penalty decays
+    below half the reuse limit."""
+
+    def __init__(self, half_life=HALF_LIFE, suppress_limit=SUPPRESS_LIMIT, reuse_limit=REUSE_LIMIT,
+                 max_suppress_time=MAX_SUPPRESS_TIME):
+        self.half_life = half_life
+        self.suppress_limit = suppress_limit
+        self.reuse_limit = reuse_limit
+        self.max_penalty = reuse_limit * 2 ** (max_suppress_time / half_life)
+        self.state = {}  # prefix -> [penalty, time of last update, damped]
+
+    def __len__(self):
+        return len(self.state)
+
+    def damped_count(self):
+        return sum(1 for penalty, updated, damped in self.state.values() if damped)
+
+    def record(self, prefix, withdrawal, previous_withdrawal, now=None):
+        """Record a flap of *prefix*: a change from the last announced or
+        withdrawn state.  Re-announcing a withdrawn route adds no penalty."""
+        if withdrawal and not previous_withdrawal:
+            increment = WITHDRAWAL_PENALTY
+        elif previous_withdrawal and not withdrawal:
+            increment = 0
+        else:
+            increment = ATTRIBUTE_CHANGE_PENALTY
+        now = time.time() if now is None else now
+        penalty, damped = self.get(prefix, now)
+        penalty = min(penalty + increment, self.max_penalty)
+        self.state[prefix] = [penalty, now, damped or penalty > self.suppress_limit]
+
+    def get(self, prefix, now=None):
+        """Return the current (penalty, damped) of *prefix*."""
+        if prefix not in self.state:
+            return 0, False
+        now = time.time() if now is None else now
+        penalty, updated, damped = self.state[prefix]
+        penalty = decay(penalty, now - updated, self.half_life)
+        return penalty, damped and penalty > self.reuse_limit
+
+    def expire(self, now=None):
+        """Forget prefixes whose penalty has decayed away."""
+        now = time.time() if now is None else now
+        for prefix in [prefix for prefix in self.state if self.get(prefix, now)[0] < self.reuse_limit / 2]:
+            del self.state[prefix]
@@ -1,30 +1,54 @@
 import constants as C
 import dns.resolver
 import time
+import threading
 from collections import Counter
+from datetime import datetime, timezone
 from flask import jsonify
-from itertools import islice
-from pymongo import MongoClient
-from functions import asn_name_query
+from mongo import get_db, get_stats_db
+from snapshot import Snapshot
+from events import EventBroker
+from leader import Lease
+from functions import asn_name_query, asn_names, community_filter
+
+CHURN_MAX_AGE = 120  # Seconds after which an unchanged ingest_stats document means the ingester has stopped
 
 
 class Stats(object):
+    ADVANCED_FIELDS = {'as_path': 1, 'communities': 1, 'ip_version': 1, 'nexthop_asn': 1}  # read by advanced_facets()
+    COUNTER_FIELDS = ('peer_count', 'ipv4_table_size', 'ipv6_table_size', 'nexthop_ip_count', 'avg_as_path_length',
+                      'customer_count', 'customer_ipv4_prefixes', 'customer_ipv6_prefixes')  # the dashboard's counters
+
     def __init__(self):
-        self.db = self.db_connect()
-        self.peer_counter = 0
-        self.ipv4_table_size = 0
-        self.ipv6_table_size = 0
-        self.nexthop_ip_counter = 0
-        self.avg_as_path_length = 0
-        self.top_n_peers = []
-        self.cidr_breakdown = []
-        self.communities = []
-        self.peers = []
-        self.customers = []
-        self.customer_count = 0
-        self.customer_ipv4_prefixes = 0
-        self.customer_ipv6_prefixes = 0
-        self.timestamp = self.epoch_to_date(time.time())
+        self.data = {
+            'peer_count': 0,
+            'ipv6_table_size': 0,
+            'ipv4_table_size': 0,
+            'nexthop_ip_count': 0,
+            'avg_as_path_length': 0,
+            'top_n_peers': [],
+            'cidr_breakdown': [],
+            'communities': [],
+            'peers': [],
+            'customers': [],
+            'customer_count': 0,
+            'customer_ipv4_prefixes': 0,
+            'customer_ipv6_prefixes': 0,
+            'timings': {},
+            'churn': None,
+            'jobs': {},
+            'timestamp': self.epoch_to_date(time.time())}  # replaced whole by swap()
+        self.lock = threading.Lock()  # held while swapping in new data
+        self.timings = {}  # metric -> seconds its last update took
+        self.use_counters = False  # read bgp_counters kept by the ingester instead of scanning bgp
+        self.churn_sample = None  # (started, updated, updates) from the last ingest_stats document read
+        self.churn_rate = None
+        self.jobs = None  # callable returning the stats jobs' costs and intervals, set by the app
+        self.snapshots = {}  # name -> Snapshot, replaced as a whole by publish()
+        self.events = EventBroker()  # changes pushed to /stream subscribers
+        self.lease = Lease(lambda: get_db().locks, 'stats')  # held by the one process computing the stats
+        self.loaded = None  # updated time of the shared stats last loaded
+        self.publish()
 
     # @property
     # def peer_counter(self):
@@ -34,135 +58,331 @@ class Stats(object):
     # def peer_counter(self):
     #     self._peer_counter = len(self.db.bgp.distinct('nexthop_asn', {'active': True}))
 
-    def db_connect(self):
-        """Return a connection to the Mongo Database."""
-        client = MongoClient(host='mongodb')
-        return client.bgp
+    @property
+    def db(self):
+        """The Mongo Database, read with the stats read preference.  Looked up
+        on each use, since a forked worker has to use its own client."""
+        return get_stats_db()
+
+    def counters_ready(self):
+        """Return True once the ingester has built the bgp_counters collection."""
+        return self.db.bgp_counters.find_one({'_id': 'reconciled'}, {'_id': 1}) is not None
 
-    def take(self, n, iterable):
-        """Return first n items of the iterable as a list."""
-        return list(islice(iterable, n))
+    def counters(self, kind, **query):
+        """Return the non-zero bgp_counters documents of *kind*."""
+        return self.db.bgp_counters.find(dict(query, kind=kind, count={'$gt': 0}))
 
     def peer_count(self):
         """Return the number of directly connected ASNs."""
+        if self.use_counters:
+            return len(self.db.bgp_counters.distinct('value', {'kind': 'nexthop_asn', 'count': {'$gt': 0}}))
         return len(self.db.bgp.distinct('nexthop_asn', {'active': True}))
 
     def prefix_count(self, version):
         """Given the IP version, return the number of prefixes in the database."""
-        return self.db.bgp.find({'ip_version': version, 'active': True}).count()
+        if self.use_counters:
+            return sum(counter['count'] for counter in self.counters('version', ip_version=version))
+        return self.db.bgp.count_documents({'ip_version': version, 'active': True})
 
     def nexthop_ip_count(self):
         """Return the number of unique next hop IPv4 and IPv6 addresses."""
+        if self.use_counters:
+            return len(self.db.bgp_counters.distinct('value', {'kind': 'nexthop', 'count': {'$gt': 0}}))
         return len(self.db.bgp.distinct('nexthop', {'active': True}))
 
     def epoch_to_date(self, epoch):
         """Given an *epoch* time stamp, return a human readable equivalent."""
         return time.strftime('%Y-%m-%d %H:%M:%S %Z', time.gmtime(epoch))
 
-    def get_list_of(self, customers=False, peers=False, community=C.CUSTOMER_BGP_COMMUNITY):
+    def origin_counts(self, asns):
+        """Return {(asn, ip_version): active prefixes originated} for *asns*,
+        in one query."""
+        if self.use_counters:
+            return {(counter['value'], counter['ip_version']): counter['count']
+                    for counter in self.counters('origin_asn', value={'$in': list(asns)})}
+        pipeline = [{'$match': {'origin_asn': {'$in': list(asns)}, 'active': True}},
+                    {'$group': {'_id': {'asn': '$origin_asn', 'ip_version': '$ip_version'}, 'count': {'$sum': 1}}}]
+        return {(group['_id']['asn'], group['_id']['ip_version']): group['count']
+                for group in self.db.bgp.aggregate(pipeline)}
+
+    def get_list_of(self, facets, customers=False, peers=False, community=C.CUSTOMER_BGP_COMMUNITY):
         """Return a list of prefix dictionaries.  Specify which type of prefix to
-        return by setting *customers* or *peers* to True."""
+        return by setting *customers* or *peers* to True.  Next-hop and
+        downstream counts come from the advanced *facets* results, so the
+        whole list takes a constant number of queries."""
+        nexthop_counts = {(group['_id']['asn'], group['_id']['ip_version']): group['count']
+                          for group in facets['nexthop_asns']}
+        downstream_counts = {group['_id']: group['count'] for group in facets['downstream_asns']}
         if peers:
-            query_results = {prefix['nexthop_asn'] for prefix in self.db.bgp.find({'active': True})}
+            query_results = {asn for asn, ip_version in nexthop_counts}
         if customers:
-            query_results = {prefix['nexthop_asn'] for prefix in self.db.bgp.find({'communities': community, 'active': True})}
+            query_results = set(self.db.bgp.distinct('nexthop_asn', {'communities': community, 'active': True}))
+        origin_counts = self.origin_counts(query_results)
+        names = asn_names(query_results)
         return [{'asn': asn if asn is not None else C.DEFAULT_ASN,  # Set "None" ASNs to default
-                 'name': asn_name_query(asn),
-                 'ipv4_origin_count': self.db.bgp.find({'origin_asn': asn, 'ip_version': 4, 'active': True}).count(),
-                 'ipv6_origin_count': self.db.bgp.find({'origin_asn': asn, 'ip_version': 6, 'active': True}).count(),
-                 'ipv4_nexthop_count': self.db.bgp.find({'nexthop_asn': asn, 'ip_version': 4, 'active': True}).count(),
-                 'ipv6_nexthop_count': self.db.bgp.find({'nexthop_asn': asn, 'ip_version': 6, 'active': True}).count(),
-                 'asn_count':  len(self.db.bgp.distinct('as_path.1', {'nexthop_asn': asn, 'active': True}))}
+                 'name': names[asn],
+                 'ipv4_origin_count': origin_counts.get((asn, 4), 0),
+                 'ipv6_origin_count': origin_counts.get((asn, 6), 0),
+                 'ipv4_nexthop_count': nexthop_counts.get((asn, 4), 0),
+                 'ipv6_nexthop_count': nexthop_counts.get((asn, 6), 0),
+                 'asn_count': downstream_counts.get(asn, 0)}
                 for asn in query_results]
 
-    def avg_as_path_len(self, decimal_point_accuracy=2):
-        """Return the computed average *as_path* length of all prefixes in the
-        database.  Using a python *set* to remove any AS prepending."""
-        as_path_counter = 0
-        all_prefixes = self.db.bgp.find({'active': True})
-        for prefix in all_prefixes:
-            try:
-                as_path_counter += len(set(prefix['as_path']))  # sets remove duplicate ASN prepending
-            except Exception:
-                pass
-        return round(as_path_counter/(all_prefixes.count() * 1.0), decimal_point_accuracy)
-
-    def communities_count(self):
-        """Return a list of BGP communities and their count"""
-        return [{'community': community,
-                 'count': self.db.bgp.find({'communities': {'$regex': str(community)}, 'active': True}).count(),
-                 'name': None if C.BGP_COMMUNITY_MAP.get(community) is None else C.BGP_COMMUNITY_MAP.get(community)}
-                for community in self.db.bgp.distinct('communities') if community is not None]
-
-    def cidrs(self):
-        """ Return a list of IPv4 and IPv6 network mask counters."""
-        ipv4_masks = [int(prefix['_id'].split('/', 1)[1])
-                      for prefix in self.db.bgp.find({'ip_version': 4, 'active': True})]
-        ipv6_masks = [int(prefix['_id'].split('/', 1)[1])
-                      for prefix in self.db.bgp.find({'ip_version': 6, 'active': True})]
-        # Use a *Counter* to count masks in the lists, then combine, sort on mask, and return results
-        return sorted(
-               [{'mask': mask,
-                 'count': count,
-                 'ip_version': 4}
-                for mask, count in list(Counter(ipv4_masks).items())]
-               +
-               [{'mask': mask,
-                 'count': count,
-                 'ip_version': 6}
-                for mask, count in list(Counter(ipv6_masks).items())], key=lambda x: x['mask'])
-
-    def top_peers(self, count):
-        """Return a sorted list of top peer dictionaries ordered by prefix count.
-        Limit to *count*."""
-        peers = {peer: self.db.bgp.find({'nexthop_asn': peer, 'active': True}).count()
-                 for peer in self.db.bgp.distinct('nexthop_asn')}
-        return [{'asn': asn[0],
-                 'count': asn[1],
-                 'name': asn_name_query(asn[0])}
-                for asn in self.take(count, sorted(peers.items(), key=lambda x: x[1], reverse=True))]
+    def timed(self, metric, func, *args, **kwargs):
+        """Return func(*args, **kwargs), recording its run time under *metric*
+        in self.timings."""
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings[metric] = round(time.perf_counter() - started, 4)
+        return result
+
+    def advanced_facets(self, top_n=5):
+        """Return the $facet stages computed over the active routes by
+        aggregate_advanced(), keyed by name.  Each sees only the fields
+        projected in ADVANCED_FIELDS."""
+        return {
+            'as_path_length': [  # $setUnion removes duplicate ASN prepending
+                {'$group': {'_id': None,
+                            'total': {'$sum': {'$size': {'$setUnion': [{'$ifNull': ['$as_path', []]}, []]}}},
+                            'prefixes': {'$sum': 1}}}],
+            'masks': [
+                {'$group': {'_id': {'mask': {'$arrayElemAt': [{'$split': ['$_id', '/']}, 1]},
+                                    'ip_version': '$ip_version'},
+                            'count': {'$sum': 1}}}],
+            'top_peers': [
+                {'$group': {'_id': '$nexthop_asn', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1}},
+                {'$limit': top_n}],
+            'nexthop_asns': [
+                {'$group': {'_id': {'asn': '$nexthop_asn', 'ip_version': '$ip_version'}, 'count': {'$sum': 1}}}],
+            'downstream_asns': [  # distinct as_path.1 per next-hop ASN
+                {'$match': {'as_path.1': {'$exists': True}}},
+                {'$group': {'_id': {'asn': '$nexthop_asn', 'downstream': {'$arrayElemAt': ['$as_path', 1]}}}},
+                {'$group': {'_id': '$_id.asn', 'count': {'$sum': 1}}}],
+            'communities': [  # prefixes per community, each counted once per prefix
+                {'$project': {'communities': {'$setUnion': [{'$ifNull': ['$communities', []]}, []]}}},
+                {'$unwind': '$communities'},
+                {'$group': {'_id': '$communities', 'count': {'$sum': 1}}}],
+        }
+
+    def aggregate_advanced(self, top_n=5, names=None):
+        """Run the advanced facets (or only those in *names*) in one
+        aggregation pass over the active routes and return {facet name:
+        results}."""
+        facets = self.advanced_facets(top_n)
+        if names is not None:
+            facets = {name: facets[name] for name in names}
+        pipeline = [{'$match': {'active': True}},
+                    {'$project': self.ADVANCED_FIELDS},
+                    {'$facet': facets}]
+        return next(self.db.bgp.aggregate(pipeline, allowDiskUse=True))
+
+    def advanced_results(self, top_n=5):
+        """Return the advanced facet results, from bgp_counters once the
+        ingester has built it.  Either way all facets come from one query,
+        timed as a whole under 'advanced_counters' or 'advanced_aggregate':
+        there is no time per facet, so a slow facet cannot be told apart."""
+        if self.counters_ready():
+            return self.timed('advanced_counters', self.counter_facets, top_n)
+        return self.timed('advanced_aggregate', self.aggregate_advanced, top_n)
+
+    def counter_facets(self, top_n=5):
+        """Return the same results as aggregate_advanced(), built from the
+        bgp_counters collection, without a pass over the bgp collection."""
+        prefixes = path_lengths = 0
+        masks = []
+        nexthop_asns = []
+        peers = Counter()
+        communities = Counter()
+        downstreams = set()  # (next-hop ASN, downstream ASN), over both IP versions
+        for counter in self.db.bgp_counters.find({'kind': {'$in': ['version', 'as_path_length', 'mask', 'nexthop_asn',
+                                                                   'community', 'downstream']},
+                                                  'count': {'$gt': 0}}):
+            if counter['kind'] == 'version':
+                prefixes += counter['count']
+            elif counter['kind'] == 'as_path_length':
+                path_lengths += counter['count']
+            elif counter['kind'] == 'mask':
+                masks.append({'_id': {'mask': counter['value'], 'ip_version': counter['ip_version']},
+                              'count': counter['count']})
+            elif counter['kind'] == 'community':
+                communities[counter['value']] += counter['count']
+            elif counter['kind'] == 'downstream':
+                downstreams.add(tuple(counter['value']))
+            else:
+                nexthop_asns.append({'_id': {'asn': counter['value'], 'ip_version': counter['ip_version']},
+                                     'count': counter['count']})
+                peers[counter['value']] += counter['count']
+        downstream_asns = Counter(asn for asn, downstream in downstreams)
+        return {'as_path_length': [{'_id': None, 'total': path_lengths, 'prefixes': prefixes}],
+                'masks': masks,
+                'top_peers': [{'_id': asn, 'count': count} for asn, count in peers.most_common(top_n)],
+                'nexthop_asns': nexthop_asns,
+                'communities': [{'_id': community, 'count': count} for community, count in communities.items()],
+                'downstream_asns': [{'_id': asn, 'count': count} for asn, count in downstream_asns.items()]}
+
+    def avg_as_path_len(self, as_path_length, decimal_point_accuracy=2):
+        """Given the *as_path_length* facet results, return the average
+        *as_path* length of all active prefixes, ignoring AS prepending."""
+        if not as_path_length or not as_path_length[0]['prefixes']:
+            return 0
+        return round(as_path_length[0]['total'] / as_path_length[0]['prefixes'], decimal_point_accuracy)
+
+    def communities_count(self, facets):
+        """Given the advanced *facets* results, return a list of BGP
+        communities and their count of active prefixes."""
+        return [{'community': community['_id'],
+                 'count': community['count'],
+                 'name': C.BGP_COMMUNITY_MAP.get(community['_id'])}
+                for community in sorted(facets['communities'], key=lambda community: community['_id'])
+                if community['_id'] is not None]
+
+    def community_count(self, pattern):
+        """Return the number of active prefixes carrying a community that is,
+        or matches, *pattern*.  Uses the communities index."""
+        return self.db.bgp.count_documents({'communities': community_filter(pattern), 'active': True})
+
+    def cidrs(self, masks):
+        """Given the *masks* facet results, return a list of IPv4 and IPv6
+        network mask counters sorted on mask."""
+        return sorted([{'mask': int(mask['_id']['mask']),
+                        'count': mask['count'],
+                        'ip_version': mask['_id']['ip_version']}
+                       for mask in masks if mask['_id'].get('mask') is not None],
+                      key=lambda x: (x['mask'], x['ip_version']))
+
+    def top_peers(self, top_peers):
+        """Given the *top_peers* facet results, return a list of top peer
+        dictionaries ordered by prefix count."""
+        return [{'asn': peer['_id'],
+                 'count': peer['count'],
+                 'name': asn_name_query(peer['_id'])}
+                for peer in top_peers]
 
     def get_data(self, json=False):
-        data_dict = {
-            'peer_count': self.peer_counter,
-            'ipv6_table_size': self.ipv6_table_size,
-            'ipv4_table_size': self.ipv4_table_size,
-            'nexthop_ip_count': self.nexthop_ip_counter,
-            'avg_as_path_length': self.avg_as_path_length,
-            'top_n_peers': self.top_n_peers,
-            'cidr_breakdown': self.cidr_breakdown,
-            'communities': self.communities,
-            'peers': self.peers,
-            'customers': self.customers,
-            'customer_count': self.customer_count,
-            'customer_ipv4_prefixes': self.customer_ipv4_prefixes,
-            'customer_ipv6_prefixes': self.customer_ipv6_prefixes,
-            'timestamp': self.timestamp}
+        """Return the current data.  It is replaced whole, never changed in
+        place, so it is always from one complete update."""
         if json:
-            return jsonify(data_dict)
+            return jsonify(self.data)
         else:
-            return data_dict
+            return self.data
 
-    def update_stats(self):
-        self.peer_counter = self.peer_count()
-        self.ipv4_table_size = self.prefix_count(4)
-        self.ipv6_table_size = self.prefix_count(6)
-        self.nexthop_ip_counter = self.nexthop_ip_count()
-        self.timestamp = self.epoch_to_date(time.time())
+    def swap(self, results):
+        """Replace the data with a copy holding *results*, the latest
+        timings, churn and job stats and a new timestamp, and publish it.
+        They travel with the data to the other workers, which run no jobs."""
+        with self.lock:
+            self.data = dict(self.data, **results, timings=dict(self.timings), churn=self.churn_rate,
+                             jobs=self.jobs() if self.jobs else {}, timestamp=self.epoch_to_date(time.time()))
+            self.publish()
+
+    def publish(self):
+        """Publish snapshots of the current data: 'stats' (all of
+        get_data()), 'counters' (COUNTER_FIELDS, polled by the dashboard) and
+        the 'peers' and 'customers' tables.  Unchanged data keeps its
+        snapshot, version and ETag.
+
+        Each changed snapshot is announced on self.events: 'counters' with
+        the counters that changed, the tables with their new version."""
+        data = self.get_data()
+        views = {'stats': data,
+                 'counters': {field: data[field] for field in self.COUNTER_FIELDS},
+                 'peers': data['peers'],
+                 'customers': data['customers']}
+        snapshots = {}
+        for name, view in views.items():
+            current = self.snapshots.get(name)
+            snapshots[name] = current.replace(view) if current else Snapshot(view)
+        previous, self.snapshots = self.snapshots, snapshots
+        if not previous:
+            return
+        if snapshots['counters'] is not previous['counters']:
+            old = previous['counters'].data
+            self.events.publish('counters', {field: value for field, value in snapshots['counters'].data.items()
+                                             if old.get(field) != value})
+        for name in ('peers', 'customers'):
+            if snapshots[name] is not previous[name]:
+                self.events.publish(name, {'version': snapshots[name].version, 'etag': snapshots[name].etag})
+
+    def store(self):
+        """Write the current data to the shared dashboard_stats document."""
+        get_db().dashboard_stats.replace_one({'_id': 'dashboard'},
+                                             {'_id': 'dashboard',
+                                              'owner': self.lease.owner,
+                                              'updated': datetime.now(timezone.utc),
+                                              'data': self.get_data()},
+                                             upsert=True)
+
+    def load(self):
+        """Take the data from the shared dashboard_stats document if the
+        leader has written it since the last load, and publish it."""
+        query = {'_id': 'dashboard'}
+        if self.loaded is not None:
+            query['updated'] = {'$gt': self.loaded}
+        document = get_db().dashboard_stats.find_one(query)
+        if document is None:
+            return
+        with self.lock:
+            self.data = document['data']
+            self.publish()
+        self.loaded = document['updated']
 
+    def refresh(self):
+        """The frequent stats job.  One process, the holder of the stats
+        lease, updates the stats and stores them; the rest load what it
+        stored, so the work is the same for any number of uwsgi workers."""
+        if self.lease.acquire():
+            self.update_stats()
+            self.store()
+        else:
+            self.load()
+
+    def refresh_advanced(self):
+        """The advanced stats job, run only by the holder of the lease."""
+        if self.lease.acquire():
+            self.update_advanced_stats()
+            self.store()
+
+    def churn(self):
+        """Return the ingester's updates per second between its last two
+        ingest_stats documents, or None if unknown.  Only the process
+        computing the stats asks, so only its jobs slow down when quiet."""
+        if not self.lease.held:
+            return None
+        document = get_db().ingest_stats.find_one({'_id': 'ingester'}, {'started': 1, 'updated': 1, 'counters.updates': 1})
+        if document is None:
+            return None
+        updated = document['updated'].replace(tzinfo=timezone.utc)
+        if time.time() - updated.timestamp() > CHURN_MAX_AGE:
+            return 0  # the ingester has stopped, so nothing is changing
+        sample = (document['started'], updated, document['counters'].get('updates', 0))
+        previous = self.churn_sample
+        if previous is not None and previous[0] == sample[0] and previous[1] < sample[1]:
+            self.churn_rate = (sample[2] - previous[2]) / (sample[1] - previous[1]).total_seconds()
+            self.churn_sample = sample
+        elif previous is None or previous[0] != sample[0]:
+            self.churn_sample = sample
+        return self.churn_rate
+
+    def update_stats(self):
+        self.use_counters = self.counters_ready()
+        self.swap({'peer_count': self.timed('peer_count', self.peer_count),
+                   'ipv4_table_size': self.timed('ipv4_table_size', self.prefix_count, 4),
+                   'ipv6_table_size': self.timed('ipv6_table_size', self.prefix_count, 6),
+                   'nexthop_ip_count': self.timed('nexthop_ip_count', self.nexthop_ip_count)})
 
     def update_advanced_stats(self):
-        self.avg_as_path_length = self.avg_as_path_len()
-        self.top_n_peers = self.top_peers(5)
-        self.cidr_breakdown = self.cidrs()
-        # self.customers = self.get_list_of(customers=True)
-        self.communities = self.communities_count()
-        self.customers = self.get_list_of(customers=True)
-        self.peers = self.get_list_of(peers=True)
-        self.customer_count = len(self.customers)
-        self.customer_ipv4_prefixes = 0
-        self.customer_ipv6_prefixes = 0
-        for customer in self.customers:
-            self.customer_ipv4_prefixes += customer['ipv4_origin_count']
-            self.customer_ipv6_prefixes += customer['ipv6_origin_count']
-        self.timestamp = self.epoch_to_date(time.time())
+        """Only the whole facet pass is timed (see advanced_results()), not
+        each facet; of the steps after it, only those that query Mongo or
+        resolve names are timed."""
+        facets = self.advanced_results(5)
+        customers = self.timed('customers', self.get_list_of, customers=True, facets=facets)
+        self.swap({'avg_as_path_length': self.avg_as_path_len(facets['as_path_length']),
+                   'top_n_peers': self.timed('top_n_peers', self.top_peers, facets['top_peers']),
+                   'cidr_breakdown': self.cidrs(facets['masks']),
+                   'communities': self.communities_count(facets),
+                   'peers': self.timed('peers', self.get_list_of, peers=True, facets=facets),
+                   'customers': customers,
+                   'customer_count': len(customers),
+                   'customer_ipv4_prefixes': sum(customer['ipv4_origin_count'] for customer in customers),
+                   'customer_ipv6_prefixes': sum(customer['ipv6_origin_count'] for customer in customers)})
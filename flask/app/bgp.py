@@ -1,17 +1,87 @@
+import re
+import json
+import time
 import threading
 
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, jsonify, render_template, request
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
 
 import constants as C
-from apscheduler.schedulers.background import BackgroundScheduler
-from functions import (asn_name_query, get_ip_json, is_peer, is_transit,
-                       reverse_dns_query, dns_query)
+from functions import (asn_name_query, asn_names, community_matches, get_ip_json, is_peer, is_transit, resolve_many, transit_query,
+                       reverse_dns_names, dns_query, get_flapping_prefixes, prefix_index, dns_cache,
+                       find_networks, parse_query)
 from Stats import Stats
+from scheduler import Scheduler
+from mongo import get_db, timings
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 
+NDJSON = 'application/x-ndjson'
+LIST_BATCH = 1000  # Documents read, and next hops resolved, at a time when streaming a prefix list
+ASN_PREFIX_FIELDS = {'origin_asn': 1, 'nexthop': 1, 'nexthop_asn': 1, 'as_path': 1, 'communities': 1, 'age': 1}
+
+
+def snapshot_response(snapshot):
+    """Serve a Stats *snapshot*: 304 Not Modified if the client's
+    If-None-Match has its ETag, else its JSON, gzipped when accepted."""
+    if snapshot.etag in request.if_none_match:
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(snapshot.gzipped, mimetype='application/json', headers={'Content-Encoding': 'gzip'})
+    else:
+        response = Response(snapshot.body, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'  # revalidate each poll, a 304 while unchanged
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def prefix_rows(cursor, rows):
+    """Yield the rows *rows* makes of each LIST_BATCH documents from *cursor*."""
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) == LIST_BATCH:
+            yield from rows(batch)
+            batch = []
+    if batch:
+        yield from rows(batch)
+
+
+def prefix_listing(summary, query, count_key, list_key, fields=None, rows=None):
+    """Respond with the active prefixes matching *query*, in prefix order,
+    as *summary* plus *count_key* and *list_key*.  *rows* makes list rows
+    from a batch of documents projected to *fields*; by default a row is
+    the prefix.
+
+    ?after=<prefix>&limit=<n> return one page, with next_after set to the
+    ?after= of the next page (None on the last).  Clients accepting
+    application/x-ndjson get one JSON row per line instead, read from the
+    cursor as the response is written."""
+    after = request.args.get('after')
+    try:
+        limit = int(request.args.get('limit', 0))
+    except ValueError:
+        return jsonify({'error': f'Invalid limit: {request.args["limit"]}'}), 400
+    if limit < 0:
+        return jsonify({'error': f'Invalid limit: {limit}'}), 400
+    rows = rows or (lambda documents: (document['_id'] for document in documents))
+    db = get_db()
+    cursor = db.bgp.find(dict(query, _id={'$gt': after}) if after else query, fields or {'_id': 1},
+                         sort=[('_id', ASCENDING)], limit=limit, batch_size=LIST_BATCH)
+    if request.accept_mimetypes.best == NDJSON:
+        return Response((json.dumps(row) + '\n' for row in prefix_rows(cursor, rows)), mimetype=NDJSON)
+
+    documents = list(cursor)
+    summary[count_key] = db.bgp.count_documents(query) if after or limit else len(documents)
+    summary[list_key] = list(rows(documents))
+    if limit:
+        summary['next_after'] = documents[-1]['_id'] if len(documents) == limit else None
+    return jsonify(summary)
+
 
 @app.route('/', methods=['GET'])
 def bgp_index():
@@ -30,12 +100,12 @@ def bgp_index():
 
 @app.route('/bgp/api/v1.0/peers', methods=['GET'])
 def get_peers():
-    return jsonify(myStats.get_list_of(peers=True))
+    return snapshot_response(myStats.snapshots['peers'])
 
 
 @app.route('/bgp/api/v1.0/customers', methods=['GET'])
 def get_customers():
-    return jsonify(myStats.get_list_of(customers=True))
+    return snapshot_response(myStats.snapshots['customers'])
 
 
 @app.route('/bgp/api/v1.0/ip/<ip>', methods=['GET'])
@@ -43,160 +113,250 @@ def get_ip(ip):
     return jsonify(get_ip_json(ip, include_history=False))
 
 
+@app.route('/bgp/api/v1.0/ip/bulk', methods=['POST'])
+def get_ip_bulk():
+    # JSON body: a list of IP addresses and prefixes, or {"addresses": [...], "dns": true} to add names
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        addresses, dns = body.get('addresses'), body.get('dns', False)
+        if not isinstance(dns, bool):
+            return jsonify({'error': 'Expected dns to be true or false'}), 400
+    else:
+        addresses, dns = body, False
+    dns = dns or request.args.get('dns', '').lower() in ('1', 'true', 'yes')
+    if not isinstance(addresses, list) or not all(isinstance(address, str) for address in addresses):
+        return jsonify({'error': 'Expected a JSON list of IP addresses or prefixes'}), 400
+    if len(addresses) > C.BULK_LIMIT:
+        return jsonify({'error': f'At most {C.BULK_LIMIT} addresses per request'}), 413
+
+    targets = {}
+    errors = {}
+    for address in addresses:
+        try:
+            targets[address] = parse_query(address)
+        except ValueError as err:
+            errors[address] = str(err)
+    routes = find_networks(targets)
+    if dns:  # both lookups share one deadline
+        deadline = time.monotonic() + C.DNS_DEADLINE
+        names = asn_names(route['origin_asn'] for route in routes.values() if route)
+        nexthop_names = reverse_dns_names((route['nexthop'] for route in routes.values() if route),
+                                          max(deadline - time.monotonic(), 0))
+
+    results = []
+    for address in addresses:
+        route = routes.get(address)
+        if address in errors:
+            results.append({'query': address, 'error': errors[address]})
+        elif route is None:
+            results.append({'query': address, 'prefix': None})
+        else:
+            result = {'query': address,
+                      'prefix': route['_id'],
+                      'ip_version': route['ip_version'],
+                      'is_transit': is_transit(route),
+                      'origin_asn': route['origin_asn'],
+                      'nexthop': route['nexthop'],
+                      'nexthop_asn': route['nexthop_asn'],
+                      'as_path': route['as_path'],
+                      'communities': route['communities'],
+                      'age': route['age']}
+            if dns:
+                result['name'] = names[route['origin_asn']]
+                result['nexthop_ip_dns'] = nexthop_names[route['nexthop']]
+            results.append(result)
+    return jsonify({'count': len(results),
+                    'matched': sum(1 for result in results if result.get('prefix')),
+                    'results': results})
+
+
 @app.route('/bgp/api/v1.0/communities', methods=['GET'])
 def get_communities():
-    return jsonify(myStats.communities_count())
+    # Optional ?match= community or pattern (e.g. 3701:39.) adds the number of prefixes carrying any match
+    communities = myStats.get_data()['communities']
+    pattern = request.args.get('match')
+    if pattern is None:
+        return jsonify(communities)
+    try:
+        return jsonify({'match': pattern,
+                        'count': myStats.community_count(pattern),
+                        'communities': [community for community in communities
+                                        if community_matches(community['community'], pattern)]})
+    except re.error as err:
+        return jsonify({'error': f'Invalid pattern: {err}'}), 400
+    except OperationFailure as err:  # a pattern Python accepts but Mongo's regex engine does not
+        return jsonify({'error': f'Invalid pattern: {err}'}), 400
 
 
 @app.route('/bgp/api/v1.0/ip/<ip>/history', methods=['GET'])
 def get_history(ip):
-    return jsonify(get_ip_json(ip, include_history=True))
+    # Optional ?since=&until= (epoch or YYYY-MM-DD[ HH:MM:SS], UTC) and ?limit= narrow the history
+    try:
+        return jsonify(get_ip_json(ip, include_history=True))
+    except ValueError as err:
+        return jsonify({'error': str(err)}), 400
 
 
-@app.route('/bgp/api/v1.0/asn/<int:asn>', methods=['GET'])
-def get_asn_prefixes(asn):
-    db = myStats.db
-    prefixes = []
+@app.route('/bgp/api/v1.0/flapping', methods=['GET'])
+def get_flapping():
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': f'Invalid limit: {request.args["limit"]}'}), 400
+    if limit < 0:
+        return jsonify({'error': f'Invalid limit: {limit}'}), 400
+    return jsonify(get_flapping_prefixes(limit=limit))
 
-    if asn == C.DEFAULT_ASN:
-        routes = db.bgp.find({'origin_asn': None, 'active': True})
-    else:
-        routes = db.bgp.find({'origin_asn': asn, 'active': True})
-
-    for prefix in routes:
-        prefixes.append({'prefix': prefix['_id'],
-                         'is_transit': is_transit(prefix),
-                         'origin_asn': prefix['origin_asn'],
-                         'name': asn_name_query(asn),
-                         'nexthop_ip': prefix['nexthop'],
-                         'nexthop_ip_dns': reverse_dns_query(prefix['nexthop']),
-                         'nexthop_asn': prefix['nexthop_asn'],
-                         'as_path': prefix['as_path'],
-                         'updated': prefix['age']
-                         })
 
-    return jsonify({'asn': asn,
-                    'name': asn_name_query(asn),
-                    'origin_prefix_count': routes.count(),
-                    'is_peer': is_peer(asn),
-                    'origin_prefix_list': prefixes})
+@app.route('/bgp/api/v1.0/mongo', methods=['GET'])
+def get_mongo_timings():
+    return jsonify(timings.summary())
+
+
+@app.route('/bgp/api/v1.0/dns/cache', methods=['GET'])
+def get_dns_cache_stats():
+    return jsonify(dns_cache.stats())
+
+
+@app.route('/bgp/api/v1.0/asn/<int:asn>', methods=['GET'])
+def get_asn_prefixes(asn):
+    name = asn_name_query(asn)
+
+    def rows(routes):
+        nexthop_names = reverse_dns_names(prefix['nexthop'] for prefix in routes)
+        for prefix in routes:
+            yield {'prefix': prefix['_id'],
+                   'is_transit': is_transit(prefix),
+                   'origin_asn': prefix['origin_asn'],
+                   'name': name,
+                   'nexthop_ip': prefix['nexthop'],
+                   'nexthop_ip_dns': nexthop_names[prefix['nexthop']],
+                   'nexthop_asn': prefix['nexthop_asn'],
+                   'as_path': prefix['as_path'],
+                   'updated': prefix['age']
+                   }
+
+    return prefix_listing({'asn': asn, 'name': name, 'is_peer': is_peer(asn)},
+                          {'origin_asn': None if asn == C.DEFAULT_ASN else asn, 'active': True},
+                          'origin_prefix_count', 'origin_prefix_list', ASN_PREFIX_FIELDS, rows)
 
 
 @app.route('/bgp/api/v1.0/stats', methods=['GET'])
 def get_stats():
-    return myStats.get_data(json=True)
+    return snapshot_response(myStats.snapshots['stats'])
+
+
+@app.route('/bgp/api/v1.0/stats/<name>', methods=['GET'])
+def get_stats_snapshot(name):
+    # counters (the dashboard's headline numbers), peers or customers
+    snapshot = myStats.snapshots.get(name)
+    if snapshot is None:
+        return jsonify({'error': f'Unknown stats: {name}'}), 404
+    return snapshot_response(snapshot)
+
+
+@app.route('/bgp/api/v1.0/scheduler', methods=['GET'])
+def get_scheduler():
+    # Each stats job's measured cost and adapted interval, and the seconds each metric last took, as of
+    # the last stats computed by the lease holder
+    data = myStats.get_data()
+    return jsonify({'churn': data['churn'],
+                    'jobs': data['jobs'],
+                    'timings': data['timings']})
+
+
+@app.route('/bgp/api/v1.0/stream', methods=['GET'])
+def get_stream():
+    # Server-sent events: all counters first, then each change to them, and the new version of a changed table
+    after = myStats.events.last_id
+    counters = myStats.snapshots['counters']
+
+    def stream():
+        yield f'retry: 5000\nid: {after}\nevent: counters\ndata: {counters.body.decode()}\n\n'
+        for event in myStats.events.subscribe(after):
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                event_id, name, data = event
+                yield f'id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n'
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/bgp/api/v1.0/asn/<int:asn>/downstream', methods=['GET'])
 def get_downstream_asns(asn):
-    db = myStats.db
+    db = get_db()
     asn_list = []
-    large_query = 200
     downstream_asns = db.bgp.distinct('as_path.1', {'nexthop_asn': asn, 'active': True})
+    names = asn_names(downstream_asns + [asn])
     for downstream in downstream_asns:
-        if len(downstream_asns) > large_query:
-            dns_name = "(LARGE QUERY - DNS LOOKUP DISABLED)"
-        else:
-            dns_name = asn_name_query(downstream)
-        asn_list.append({'asn': downstream, 'name': dns_name})
+        asn_list.append({'asn': downstream, 'name': names[downstream]})
 
     sorted_asn_list = sorted(asn_list, key=lambda k: k['asn'])
 
     return jsonify({'asn': asn,
-                    'name': asn_name_query(asn),
+                    'name': names[asn],
                     'downstream_asns_count': len(asn_list),
                     'downstream_asns': sorted_asn_list})
 
 
 @app.route('/bgp/api/v1.0/asn/<int:asn>/originated', methods=['GET'])
 def get_originated_prefixes(asn):
-    db = myStats.db
-    originated = []
-    prefixes = db.bgp.find({'origin_asn': asn, 'active': True})
-    for prefix in prefixes:
-        originated.append(prefix['_id'])
-
-    return jsonify({'asn': asn,
-                    'name': asn_name_query(asn),
-                    'originated_prefix_count': len(originated),
-                    'originated_prefix_list': originated})
+    return prefix_listing({'asn': asn, 'name': asn_name_query(asn)},
+                          {'origin_asn': asn, 'active': True},
+                          'originated_prefix_count', 'originated_prefix_list')
 
 
 @app.route('/bgp/api/v1.0/asn/<int:asn>/originated/<version>', methods=['GET'])
 def get_originated_prefixes_version(asn, version):
-    db = myStats.db
-    originated = []
     v = 4
     if version.lower() == 'ipv6':
         v = 6
-    prefixes = db.bgp.find({'origin_asn': asn, 'ip_version': v, 'active': True})
-    for prefix in prefixes:
-        originated.append(prefix['_id'])
-
-    return jsonify({'asn': asn,
-                    'name': asn_name_query(asn),
-                    'originated_prefix_count': len(originated),
-                    'originated_prefix_list': originated})
+    return prefix_listing({'asn': asn, 'name': asn_name_query(asn)},
+                          {'origin_asn': asn, 'ip_version': v, 'active': True},
+                          'originated_prefix_count', 'originated_prefix_list')
 
 
 @app.route('/bgp/api/v1.0/asn/<int:asn>/nexthop', methods=['GET'])
 def get_nexthop_prefixes(asn):
-    db = myStats.db
-    nexthop = []
-    prefixes = db.bgp.find({'nexthop_asn': asn, 'active': True})
-    for prefix in prefixes:
-        nexthop.append(prefix['_id'])
-
-    return jsonify({'asn': asn,
-                    'name': asn_name_query(asn),
-                    'nexthop_prefix_count': len(nexthop),
-                    'nexthop_prefix_list': nexthop})
+    return prefix_listing({'asn': asn, 'name': asn_name_query(asn)},
+                          {'nexthop_asn': asn, 'active': True},
+                          'nexthop_prefix_count', 'nexthop_prefix_list')
 
 
 @app.route('/bgp/api/v1.0/asn/<int:asn>/nexthop/<version>', methods=['GET'])
 def get_nexthop_prefixes_version(asn, version):
-    db = myStats.db
-    nexthop = []
     v = 4
     if version.lower() == 'ipv6':
         v = 6
-    prefixes = db.bgp.find({'nexthop_asn': asn, 'ip_version': v, 'active': True})
-    for prefix in prefixes:
-        nexthop.append(prefix['_id'])
-
-    return jsonify({'asn': asn,
-                    'name': asn_name_query(asn),
-                    'nexthop_prefix_count': len(nexthop),
-                    'nexthop_prefix_list': nexthop})
+    return prefix_listing({'asn': asn, 'name': asn_name_query(asn)},
+                          {'nexthop_asn': asn, 'ip_version': v, 'active': True},
+                          'nexthop_prefix_count', 'nexthop_prefix_list')
 
 
 @app.route('/bgp/api/v1.0/asn/<int:asn>/transit', methods=['GET'])
 def get_transit_prefixes(asn):
-    db = myStats.db
-    all_asns = db.bgp.find({'active': True})
-    prefixes = []
-
-    for prefix in all_asns:
-        if prefix['as_path']:
-            if asn in prefix['as_path']:
-                prefixes.append(prefix['_id'])
-            else:
-                pass
-        else:
-            pass
-
-    return jsonify({'asn': asn,
-                    'name': asn_name_query(asn),
-                    'transit_prefix_count': len(prefixes),
-                    'transit_prefix_list': prefixes})
+    # Optional ?position=origin|first|any (default any) and ?count=true to skip the list
+    try:
+        query = transit_query(asn, request.args.get('position', 'any'))
+    except ValueError as err:
+        return jsonify({'error': str(err)}), 400
+    if request.args.get('count', '').lower() in ('1', 'true', 'yes'):
+        return jsonify({'asn': asn,
+                        'name': asn_name_query(asn),
+                        'transit_prefix_count': get_db().bgp.count_documents(query)})
+    return prefix_listing({'asn': asn, 'name': asn_name_query(asn)}, query,
+                          'transit_prefix_count', 'transit_prefix_list')
 
 
 @app.route('/bgp/api/v1.0/domain/<domain>', methods=['GET'])
 def get_domain(domain):
     domain = domain.lower()
     org = domain.split('.')[-2]
-    name_servers = dns_query(domain, 'NS')
-    soa = dns_query(domain, 'SOA')
+    records = resolve_many(lambda query: dns_query(*query), [(domain, 'NS'), (domain, 'SOA'), (domain, 'A')])
+    name_servers = records[(domain, 'NS')]
+    soa = records[(domain, 'SOA')]
     local_ns = ''
     if org in soa.lower():
         local_ns = soa.lower()
@@ -209,14 +369,14 @@ def get_domain(domain):
         domain_ip = str(dns_query(local_ns))
         ip_data = get_ip_json(domain_ip)
         asn = ip_data.get('origin_asn')
-        db = myStats.db
+        db = get_db()
         originated = []
         prefixes = db.bgp.find({'origin_asn': asn, 'active': True})
         for prefix in prefixes:
             originated.append(prefix['_id'])
 
         return jsonify({'domain': domain,
-                        'A Record': dns_query(domain),
+                        'A Record': records[(domain, 'A')],
                         'SOA/NS Record': local_ns,
                         'SOA/NS IP': domain_ip,
                         'asn': asn,
@@ -225,12 +385,13 @@ def get_domain(domain):
                         'originated_prefix_list': originated})
 
 
-sched = BackgroundScheduler()
 myStats = Stats()
-threading.Thread(target=myStats.update_stats).start()
-threading.Thread(target=myStats.update_advanced_stats).start()
-sched.add_job(myStats.update_stats, 'interval', seconds=5)
-sched.add_job(myStats.update_advanced_stats, 'interval', seconds=60)
+sched = Scheduler(churn=myStats.churn)
+myStats.jobs = sched.stats
+threading.Thread(target=prefix_index.run, args=(get_db(),), daemon=True).start()
+threading.Thread(target=myStats.lease.run, name='stats-lease', daemon=True).start()
+sched.add_job('stats', myStats.refresh, 5, max_interval=30)
+sched.add_job('advanced_stats', myStats.refresh_advanced, 60, max_interval=600)
 sched.start()
 
 if __name__ == '__main__':
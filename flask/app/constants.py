@@ -3,6 +3,12 @@ DEFAULT_ASN = 3701
 CUSTOMER_BGP_COMMUNITY = '3701:370'  # Prefixes learned from directly connected customers
 TRANSIT_BGP_COMMUNITY = '3701:380'  # Prefixes learned from *paid* transit providers
 PEER_BGP_COMMUNITY = '3701:39.'  # Prefixes learned from bilateral peers and exchanges
+HISTORY_LIMIT = 100  # Default and maximum number of entries returned by /ip/<ip>/history
+FLAP_HALF_LIFE = 900  # Seconds for a flap penalty to decay by half (match flap_damping.HALF_LIFE)
+FLAP_REUSE_LIMIT = 750  # Penalty below which a damped prefix is released (match flap_damping.REUSE_LIMIT)
+DNS_WORKERS = 32  # Threads per process resolving names for list endpoints
+DNS_DEADLINE = 2.0  # Seconds a request waits for its names; later ones return '(DNS Timeout)'
+BULK_LIMIT = 10000  # Most addresses or prefixes looked up by one POST to /ip/bulk
 BGP_COMMUNITY_MAP = {
       '3701:111': 'Level3-Prepend-1',
       '3701:112': 'Level3-Prepend-2',
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from pymongo.errors import PyMongoError
+
+MAX_ENTRIES = 50000  # Names held in memory per process, least recently used evicted first
+MIN_TTL = 60  # Seconds; shorter DNS TTLs are raised to this
+MAX_TTL = 86400  # Seconds; longer DNS TTLs are capped to this
+NEGATIVE_TTL = 300  # Seconds to remember a failed lookup
+DNS_ERROR = '(DNS Error)'
+
+
+class DNSCache(object):
+    """Cache of names resolved from DNS, expiring each with its record TTL.
+    Failed lookups are cached as DNS_ERROR for NEGATIVE_TTL seconds.
+
+    Entries live in an LRU in memory and in the Mongo *collection* (a
+    callable returning it), which a TTL index empties, so uwsgi workers and
+    restarts share warm entries."""
+
+    def __init__(self, collection=None, max_entries=MAX_ENTRIES, negative_ttl=NEGATIVE_TTL):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # key -> (value, expiry epoch)
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.indexed = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, resolve):
+        """Return the name cached for *key*, else resolve() it.  *resolve*
+        returns (name, ttl seconds) or raises on failure."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    self.counters['negative_hits'] += entry[0] == DNS_ERROR
+                    return entry[0]
+                del self.entries[key]
+                self.counters['expired'] += 1
+        entry = self.load(key, now)
+        if entry is not None:
+            self.counters['store_hits'] += 1
+        else:
+            self.counters['misses'] += 1
+            try:
+                value, ttl = resolve()
+                ttl = min(max(ttl, MIN_TTL), MAX_TTL)
+            except Exception:
+                value, ttl = DNS_ERROR, self.negative_ttl
+                self.counters['errors'] += 1
+            entry = (value, now + ttl)
+            self.save(key, entry)
+        self.put(key, entry)
+        return entry[0]
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def load(self, key, now):
+        """Return the unexpired (value, expiry) stored for *key* in Mongo, or None."""
+        if self.collection is None:
+            return None
+        try:
+            document = self.collection().find_one({'_id': key})
+        except PyMongoError:
+            return None
+        if document is None:
+            return None
+        expires = document['expires'].replace(tzinfo=timezone.utc).timestamp()
+        return (document['value'], expires) if expires > now else None
+
+    def save(self, key, entry):
+        if self.collection is None:
+            return
+        try:
+            collection = self.collection()
+            if not self.indexed:
+                collection.create_index('expires', expireAfterSeconds=0)
+                self.indexed = True
+            collection.replace_one({'_id': key}, {'_id': key, 'value': entry[0],
+                                                  'expires': datetime.fromtimestamp(entry[1], timezone.utc)},
+                                   upsert=True)
+        except PyMongoError:
+            pass
+
+    def stats(self):
+        """Return the hit, miss and eviction counters and the cache size."""
+        lookups = self.counters['hits'] + self.counters['store_hits'] + self.counters['misses']
+        return dict(self.counters, entries=len(self),
+                    hit_ratio=round((self.counters['hits'] + self.counters['store_hits']) / lookups, 3) if lookups else None)
@@ -0,0 +1,45 @@
+import threading
+from collections import deque
+
+HISTORY = 100  # Recent events kept for subscribers catching up
+KEEPALIVE = 15  # Seconds without an event before a subscriber is sent a keepalive
+
+
+class EventBroker(object):
+    """Fan out published events to any number of subscribers.  Events are
+    numbered and the last HISTORY kept, so a subscriber can note last_id,
+    read the current state, then subscribe after that id without missing
+    what was published in between.  Subscribers wait on one condition, and
+    under uwsgi's gevent loop each costs a greenlet, not a thread."""
+
+    def __init__(self, history=HISTORY):
+        self.events = deque(maxlen=history)  # (id, name, data)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, name, data):
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, name, data))
+            self.condition.notify_all()
+
+    def pending(self, after):
+        return [event for event in self.events if event[0] > after]
+
+    def subscribe(self, after=None, keepalive=KEEPALIVE):
+        """Yield each (id, name, data) published after event id *after*, or
+        from now if None, forever.  Yield None after *keepalive* seconds
+        without an event."""
+        if after is None:
+            after = self.last_id
+        while True:
+            with self.condition:
+                events = self.pending(after)
+                if not events:
+                    self.condition.wait(keepalive)
+                    events = self.pending(after)
+            if not events:
+                yield None
+            for event in events:
+                after = event[0]
+                yield event
@@ -1,17 +1,96 @@
 import ipaddress
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait
 import dns.resolver
 import constants as C
+from datetime import datetime, timezone
 from flask import jsonify, request
-from pymongo import MongoClient
+from pymongo import DESCENDING
+from mongo import get_db
+from radix import FAMILIES, PrefixIndex, address_number
+from dns_cache import DNSCache
+
+prefix_index = PrefixIndex()  # active prefixes; loaded and kept current by a thread started in bgp.py
+dns_cache = DNSCache(collection=lambda: get_db().dns_cache)  # ASN names and reverse DNS
+DNS_TIMEOUT = '(DNS Timeout)'
+BULK_FIELDS = {'ip_version': 1, 'origin_asn': 1, 'nexthop': 1, 'nexthop_asn': 1, 'as_path': 1, 'communities': 1, 'age': 1}
+_resolver = None
+_executor = None
+_executor_pid = None
+
+
+def resolver():
+    """Return the process's DNS resolver, reading resolv.conf once."""
+    global _resolver
+    if _resolver is None:
+        _resolver = dns.resolver.Resolver()
+    return _resolver
 
 
 def db_connect():
-    """Return a connection to the Mongo Database."""
-    client = MongoClient(host='mongodb')
-    return(client.bgp)
+    """Return the Mongo Database on the process's shared, pooled client."""
+    return(get_db())
 
 
 def find_network(ip, netmask):
+    """Given an IPv4 or IPv6 address, return the most specific prefix in the
+       MongoDB collection that is active.  Uses the prefix index once it is
+       loaded, otherwise searches recursively from *netmask* down.
+    """
+    if prefix_index.loaded:
+        try:
+            prefix = prefix_index.lookup(ip)
+        except ValueError:
+            return(None)
+        if prefix is None:
+            return(None)
+        result = db_connect().bgp.find_one({'_id': prefix, 'active': True})
+        if result is not None:
+            return(result)
+    return(find_network_recursive(ip, netmask))
+
+
+def parse_query(query):
+    """Given an IP address or prefix, return (address, mask length), the
+    length being the full address length for an address.  Raise
+    ValueError if it is neither."""
+    address, _, length = query.strip().partition('/')
+    bits = FAMILIES[address_number(address)[0]][1]
+    if not length:
+        return address, bits
+    if not length.isdigit() or int(length) > bits:
+        raise ValueError(f'Invalid mask length: {query}')
+    return address, int(length)
+
+
+def find_networks(targets):
+    """Given {query: (address, mask length)}, return {query: the active
+    route of the most specific prefix covering address/length, or None}.
+    The prefixes come from the prefix index and their routes from one $in
+    query; queries it cannot answer, before it is loaded or when it lags
+    the collection, are searched recursively like find_network()."""
+    prefixes = {}
+    if prefix_index.loaded:
+        prefixes = {query: prefix_index.lookup(address, length) for query, (address, length) in targets.items()}
+    matched = list({prefix for prefix in prefixes.values() if prefix is not None})
+    routes = {}
+    if matched:
+        routes = {route['_id']: route for route in db_connect().bgp.find({'_id': {'$in': matched}, 'active': True},
+                                                                         BULK_FIELDS)}
+    results = {}
+    for query, (address, length) in targets.items():
+        prefix = prefixes.get(query)
+        if prefix in routes:
+            results[query] = routes[prefix]
+        elif prefix_index.loaded and prefix is None:
+            results[query] = None
+        else:
+            results[query] = find_network_recursive(address, length)
+    return results
+
+
+def find_network_recursive(ip, netmask):
     """Given an IPv4 or IPv6 address, recursively search for and return the most
        specific prefix in the MongoDB collection that is active.
     """
@@ -24,11 +103,87 @@ def find_network(ip, netmask):
         elif netmask == 0:
             return(None)
         else:
-            return(find_network(ip, netmask-1))
+            return(find_network_recursive(ip, netmask-1))
     except Exception:
         return(None)
 
 
+def parse_time(value):
+    """Given an epoch or a 'YYYY-MM-DD[ HH:MM:SS]' string, return a UTC
+    datetime.  Return None if *value* is empty."""
+    if not value:
+        return None
+    try:
+        return datetime.fromtimestamp(float(value), timezone.utc)
+    except ValueError:
+        pass
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, time_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    raise ValueError(f'Unrecognized time: {value}')
+
+
+def parse_history_limit(value):
+    """Given the ?limit= of a history request, return it clamped to
+    1..HISTORY_LIMIT, or HISTORY_LIMIT if *value* is empty.  Raise
+    ValueError if it is not an integer."""
+    if not value:
+        return C.HISTORY_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError(f'Invalid limit: {value}')
+    return min(max(limit, 1), C.HISTORY_LIMIT)
+
+
+def get_prefix_history(prefix, since=None, until=None, limit=C.HISTORY_LIMIT):
+    """Return the previous versions of *prefix*, newest first.  Limit to
+    versions replaced between *since* and *until* if given."""
+    db = db_connect()
+    query = {'prefix': prefix}
+    if since or until:
+        query['timestamp'] = {}
+        if since:
+            query['timestamp']['$gte'] = since
+        if until:
+            query['timestamp']['$lte'] = until
+    history = []
+    for entry in db.bgp_history.find(query, {'_id': 0}).sort([('timestamp', DESCENDING), ('_id', DESCENDING)]).limit(limit):
+        entry['_id'] = entry.pop('prefix')
+        history.append(entry)
+    return history
+
+
+def flap_state(prefix):
+    """Given a *prefix* document, return its flap penalty decayed to now and
+    whether it is still damped."""
+    if not prefix.get('flap_penalty'):
+        return 0, False
+    elapsed = (datetime.now(timezone.utc) - prefix['flap_updated'].replace(tzinfo=timezone.utc)).total_seconds()
+    penalty = prefix['flap_penalty'] * 0.5 ** (elapsed / C.FLAP_HALF_LIFE)
+    return round(penalty), prefix.get('damped', False) and penalty > C.FLAP_REUSE_LIMIT
+
+
+def get_flapping_prefixes(limit=100):
+    """Return the prefixes with the highest flap penalties, highest first."""
+    db = db_connect()
+    flapping = []
+    for prefix in db.bgp.find({'flap_penalty': {'$gt': 0}},
+                              {'flap_penalty': 1, 'flap_updated': 1, 'flap_count': 1, 'damped': 1,
+                               'origin_asn': 1, 'active': 1}).sort('flap_penalty', DESCENDING).limit(limit):
+        penalty, damped = flap_state(prefix)
+        flapping.append({'prefix': prefix['_id'],
+                         'origin_asn': prefix['origin_asn'],
+                         'active': prefix['active'],
+                         'flap_count': prefix.get('flap_count', 0),
+                         'flap_penalty': penalty,
+                         'damped': damped,
+                         'last_flap': prefix['flap_updated']})
+    return sorted(flapping, key=lambda x: x['flap_penalty'], reverse=True)
+
+
 def is_peer(asn):
     """Is *asn* in the list of directy connected ASNs."""
     db = db_connect()
@@ -38,6 +193,33 @@ def is_peer(asn):
         return False
 
 
+def community_filter(pattern):
+    """Given a community such as '3701:370' or a pattern such as '3701:39.',
+    return a query on the *communities* field.  Communities match exactly;
+    patterns become an anchored $regex, whose literal prefix bounds the scan
+    of the communities index.  Raise re.error for an invalid pattern, before
+    it reaches Mongo."""
+    if re.fullmatch(r'\d+:\d+', pattern):
+        return pattern
+    re.compile(pattern)
+    return {'$regex': f'^{pattern}$'}
+
+
+def transit_query(asn, position='any'):
+    """Return the query for active prefixes with *asn* in their AS path at
+    *position*: 'origin', 'first' (the next-hop ASN) or 'any'.  Each is
+    served by an index on bgp."""
+    fields = {'origin': 'origin_asn', 'first': 'nexthop_asn', 'any': 'as_path'}
+    if position not in fields:
+        raise ValueError(f'Unknown position: {position} (use origin, first or any)')
+    return {fields[position]: asn, 'active': True}
+
+
+def community_matches(community, pattern):
+    """Does *community* match the community or pattern *pattern*?"""
+    return community is not None and re.fullmatch(pattern, community) is not None
+
+
 def is_transit(prefix, transit_bgp_community=C.TRANSIT_BGP_COMMUNITY):
     """Is the *prefix* counted as transit?"""
     if C.TRANSIT_BGP_COMMUNITY in prefix['communities']:
@@ -47,13 +229,11 @@ def is_transit(prefix, transit_bgp_community=C.TRANSIT_BGP_COMMUNITY):
 
 
 def reverse_dns_query(ip):
-    """Given an *ip*, return the reverse dns."""
-    try:
-        addr = dns.reversename.from_address(str(ip))
-        resolver = dns.resolver.Resolver()
-        return str(resolver.query(addr, 'PTR')[0])[:-1]
-    except Exception:
-        return('(DNS Error)')
+    """Given an *ip*, return the reverse dns.  Cached for the record's TTL."""
+    def resolve():
+        answers = resolver().query(dns.reversename.from_address(str(ip)), 'PTR')
+        return str(answers[0])[:-1], answers.rrset.ttl
+    return dns_cache.get(f'ptr:{ip}', resolve)
 
 
 def dns_query(name, type='A'):
@@ -83,14 +263,43 @@ def asn_name_query(asn):
         return('RFC5398 - Private Use ASN')
     if 64512 <= asn <= 65535 or 4200000000 <= asn <= 4294967295:
         return('RFC6996 - Private Use ASN')
-    try:
+    def resolve():
         query = 'as{number}.asn.cymru.com'.format(number=str(asn))
-        resolver = dns.resolver.Resolver()
-        answers = resolver.query(query, 'TXT')
-        for rdata in answers:
-            return(str(rdata).split('|')[-1].split(',', 2)[0].strip())
-    except Exception:
-        return '(DNS Error)'
+        answers = resolver().query(query, 'TXT')
+        return str(answers[0]).split('|')[-1].split(',', 2)[0].strip(), answers.rrset.ttl
+    return dns_cache.get(f'asn:{asn}', resolve)
+
+
+def executor():
+    """Return the process's DNS thread pool, making a new one after a fork."""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=C.DNS_WORKERS, thread_name_prefix='dns')
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def resolve_many(query, keys, deadline=C.DNS_DEADLINE):
+    """Return {key: query(key)} for the distinct *keys*, run concurrently.
+    Keys not answered within *deadline* seconds map to DNS_TIMEOUT; their
+    lookups finish in the background and land in the DNS cache."""
+    futures = {executor().submit(query, key): key for key in set(keys)}
+    done, not_done = wait(futures, timeout=deadline)
+    results = {futures[future]: future.result() for future in done}
+    results.update((futures[future], DNS_TIMEOUT) for future in not_done)
+    return results
+
+
+def asn_names(asns, deadline=C.DNS_DEADLINE):
+    """Given an iterable of *asns*, return {asn: name}, looking up each
+    distinct ASN once, concurrently."""
+    return resolve_many(asn_name_query, asns, deadline)
+
+
+def reverse_dns_names(ips, deadline=C.DNS_DEADLINE):
+    """Given an iterable of *ips*, return {ip: reverse dns}, concurrently."""
+    return resolve_many(reverse_dns_query, ips, deadline)
+
 
 def get_ip_json(ip, include_history=True):
     if '/' in ip:
@@ -110,17 +319,22 @@ def get_ip_json(ip, include_history=True):
         except Exception as e:
             return(jsonify(str(e)))
     if network:
+        flap_penalty, damped = flap_state(network)
         if include_history:
-            history = network['history']
+            history = get_prefix_history(network['_id'],
+                                         since=parse_time(request.args.get('since')),
+                                         until=parse_time(request.args.get('until')),
+                                         limit=parse_history_limit(request.args.get('limit')))
         else:
             history = request.base_url + '/history'
+        names = reverse_dns_names([network['nexthop'], network['originator_id']])
         return {'prefix': network['_id'],
                 'ip_version': network['ip_version'],
                 'is_transit': is_transit(network),
                 'origin_asn': network['origin_asn'],
                 'name': asn_name_query(network['origin_asn']),
                 'nexthop': network['nexthop'],
-                'nexthop_ip_dns': reverse_dns_query(network['nexthop']),
+                'nexthop_ip_dns': names[network['nexthop']],
                 'nexthop_asn': network['nexthop_asn'],
                 'as_path': network['as_path'],
                 'med': network['med'],
@@ -131,9 +345,12 @@ def get_ip_json(ip, include_history=True):
                 'aggregator_as': network['aggregator_as'],
                 'aggregator_address': network['aggregator_address'],
                 'originator_id': network['originator_id'],
-                'originator_id_dns': reverse_dns_query(network['originator_id']),
+                'originator_id_dns': names[network['originator_id']],
                 'cluster_list': network['cluster_list'],
                 'age': network['age'],
+                'flap_count': network.get('flap_count', 0),
+                'flap_penalty': flap_penalty,
+                'damped': damped,
                 'history': history}
     else:
         return {}
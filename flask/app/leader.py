@@ -0,0 +1,56 @@
+import os
+import time
+import socket
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+LEASE_TTL = 30  # Seconds a lease outlives its last renewal
+RENEW_FRACTION = 3  # The holder renews every LEASE_TTL / RENEW_FRACTION seconds, whatever its jobs are doing
+
+
+class Lease(object):
+    """A lease on *name* in the Mongo *collection* (a callable returning
+    it), held by at most one process at a time.  The holder renews it with
+    each acquire(), and run() calls acquire() every *ttl* / RENEW_FRACTION
+    seconds, so the lease does not depend on how often, or how long, the
+    holder's jobs run.  When the holder stops for *ttl* seconds, the next
+    process to call acquire() takes over."""
+
+    def __init__(self, collection, name, ttl=LEASE_TTL):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex[:8]
+        self.held = False
+
+    @property
+    def owner(self):
+        """This process, by host and pid, so a forked child is a different owner."""
+        return f'{socket.gethostname()}:{os.getpid()}:{self.token}'
+
+    def acquire(self):
+        """Take or renew the lease, and return True if this process holds it."""
+        now = datetime.now(timezone.utc)
+        try:
+            self.collection().find_one_and_update(
+                {'_id': self.name, '$or': [{'owner': self.owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': self.owner, 'expires': now + timedelta(seconds=self.ttl), 'renewed': now}},
+                upsert=True)
+            held = True
+        except DuplicateKeyError:  # another owner holds an unexpired lease
+            held = False
+        except PyMongoError as err:
+            logging.warning(f'Could not renew the {self.name} lease: {err}')
+            held = False
+        if held != self.held:
+            logging.info(f'{self.owner} {"took" if held else "gave up"} the {self.name} lease')
+        self.held = held
+        return held
+
+    def run(self):
+        """Renew or contend for the lease forever; start it in a daemon thread."""
+        while True:
+            self.acquire()
+            time.sleep(self.ttl / RENEW_FRACTION)
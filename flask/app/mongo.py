@@ -0,0 +1,129 @@
+"""One pooled MongoClient per process, shared by the Flask app and the
+ingester (which imports this module from flask/app).
+
+Settings come from keyword arguments to configure(), else from these
+environment variables, else the defaults below:
+
+    MONGO_HOST                         mongodb
+    MONGO_MAX_POOL_SIZE                100
+    MONGO_CONNECT_TIMEOUT_MS           5000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS  10000
+    MONGO_SOCKET_TIMEOUT_MS            none
+    MONGO_READ_PREFERENCE              primary
+    MONGO_STATS_READ_PREFERENCE        MONGO_READ_PREFERENCE, e.g. secondaryPreferred
+                                       to send the dashboard stats scans to a secondary
+    MONGO_WRITE_CONCERN                1 (w: a number or "majority")
+"""
+import os
+import threading
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+
+DATABASE = 'bgp'
+DEFAULTS = {
+    'host': 'mongodb',
+    'max_pool_size': 100,
+    'connect_timeout_ms': 5000,
+    'server_selection_timeout_ms': 10000,
+    'socket_timeout_ms': None,
+    'read_preference': 'primary',
+    'stats_read_preference': None,  # None = read_preference
+    'write_concern': 1,
+}
+
+
+class OperationTimings(monitoring.CommandListener):
+    """Count and time every command sent to Mongo, by command name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}  # command name -> [count, failures, total seconds, max seconds]
+
+    def record(self, event, failed=False):
+        seconds = event.duration_micros / 1e6
+        with self.lock:
+            operation = self.operations.setdefault(event.command_name, [0, 0, 0.0, 0.0])
+            operation[0] += 1
+            operation[1] += failed
+            operation[2] += seconds
+            operation[3] = max(operation[3], seconds)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event, failed=True)
+
+    def summary(self):
+        """Return {command name: count, failures, average and max ms}."""
+        with self.lock:
+            return {name: {'count': count,
+                           'failures': failures,
+                           'avg_ms': round(total / count * 1e3, 3),
+                           'max_ms': round(longest * 1e3, 3)}
+                    for name, (count, failures, total, longest) in sorted(self.operations.items())}
+
+
+timings = OperationTimings()
+_settings = {}
+_client = None
+_pid = None
+_lock = threading.Lock()
+
+
+def setting(name):
+    if name in _settings:
+        return _settings[name]
+    value = os.environ.get(f'MONGO_{name.upper()}')
+    if value is None:
+        return DEFAULTS[name]
+    if name == 'write_concern':
+        return int(value) if value.isdigit() else value
+    if name.endswith('_ms') or name == 'max_pool_size':
+        return int(value)
+    return value
+
+
+def configure(**settings):
+    """Override settings (see DEFAULTS) before the first get_client() in
+    this process, e.g. configure(host=args.host, write_concern=1)."""
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise TypeError(f'Unknown Mongo settings: {", ".join(sorted(unknown))}')
+    _settings.update(settings)
+
+
+def get_client():
+    """Return this process's MongoClient, creating it on first use.  A
+    client is not fork-safe, so a forked child (a uwsgi worker, say) gets a
+    new one instead of the parent's."""
+    global _client, _pid
+    if _client is None or _pid != os.getpid():
+        with _lock:
+            if _client is None or _pid != os.getpid():
+                _client = MongoClient(host=setting('host'),
+                                      maxPoolSize=setting('max_pool_size'),
+                                      connectTimeoutMS=setting('connect_timeout_ms'),
+                                      serverSelectionTimeoutMS=setting('server_selection_timeout_ms'),
+                                      socketTimeoutMS=setting('socket_timeout_ms'),
+                                      readPreference=setting('read_preference'),
+                                      w=setting('write_concern'),
+                                      event_listeners=[timings],
+                                      connect=False)
+                _pid = os.getpid()
+    return _client
+
+
+def get_db():
+    """Return the bgp database on the shared client."""
+    return get_client()[DATABASE]
+
+
+def get_stats_db():
+    """Return the bgp database read with MONGO_STATS_READ_PREFERENCE, for the
+    full-table scans behind the dashboard stats."""
+    mode = setting('stats_read_preference') or setting('read_preference')
+    return get_client().get_database(DATABASE, read_preference=make_read_preference(read_pref_mode_from_name(mode), None))
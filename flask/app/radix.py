@@ -0,0 +1,142 @@
+import socket
+import logging
+import time
+from pymongo import DESCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+POLL_INTERVAL = 5  # Seconds between polls for changed prefixes when change streams are unavailable
+RETRY_INTERVAL = 10  # Seconds before reloading after losing Mongo
+FAMILIES = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+
+def address_number(address):
+    """Given an IPv4 or IPv6 *address* string, return (ip_version, address as
+    an int).  Raise ValueError if it is neither."""
+    for version, (family, bits) in FAMILIES.items():
+        try:
+            return version, int.from_bytes(socket.inet_pton(family, address), 'big')
+        except OSError:
+            pass
+    raise ValueError(f'Invalid IP address: {address}')
+
+
+class PrefixIndex(object):
+    """Longest-prefix-match index of the active prefixes in the bgp
+    collection.  Networks are kept in one hash table per mask length, and a
+    lookup probes the mask lengths in use from longest to shortest, so it
+    costs at most one dict lookup per distinct mask length in the table
+    (about 25 for IPv4) instead of one query per bit."""
+
+    def __init__(self):
+        self.tables = {4: {}, 6: {}}  # ip_version -> {mask length: {network number: prefix}}
+        self.lengths = {4: [], 6: []}  # ip_version -> mask lengths in use, longest first
+        self.loaded = False
+
+    def __len__(self):
+        return sum(len(table) for tables in self.tables.values() for table in tables.values())
+
+    def key(self, prefix):
+        """Return (ip_version, mask length, network number) of *prefix*."""
+        address, length = prefix.rsplit('/', 1)
+        version, number = address_number(address)
+        length = int(length)
+        return version, length, number >> (FAMILIES[version][1] - length)
+
+    def add(self, prefix):
+        version, length, network = self.key(prefix)
+        table = self.tables[version].get(length)
+        if table is None:
+            table = self.tables[version][length] = {}
+            self.lengths[version] = sorted(self.tables[version], reverse=True)
+        table[network] = prefix
+
+    def remove(self, prefix):
+        version, length, network = self.key(prefix)
+        table = self.tables[version].get(length)
+        if table is not None and table.pop(network, None) is not None and not table:
+            del self.tables[version][length]
+            self.lengths[version] = sorted(self.tables[version], reverse=True)
+
+    def lookup(self, address, max_length=None):
+        """Return the most specific prefix covering *address*, or None.
+        With *max_length*, only prefixes at most that long are considered,
+        i.e. those covering the whole of address/max_length."""
+        version, number = address_number(address)
+        bits = FAMILIES[version][1]
+        tables = self.tables[version]
+        for length in self.lengths[version]:
+            if max_length is not None and length > max_length:
+                continue
+            prefix = tables.get(length, {}).get(number >> (bits - length))  # tables may be mid-reload
+            if prefix is not None:
+                return prefix
+        return None
+
+    def apply(self, prefix, active):
+        if active:
+            self.add(prefix)
+        else:
+            self.remove(prefix)
+
+    def load(self, db):
+        """Replace the index with the active prefixes in the bgp collection.
+        Until it is done, *loaded* is False and lookups fall back to Mongo."""
+        self.loaded = False
+        index = PrefixIndex()
+        for prefix in db.bgp.find({'active': True}, {'_id': 1}, batch_size=10000):
+            index.add(prefix['_id'])
+        self.tables, self.lengths = index.tables, index.lengths
+        self.loaded = True
+        logging.info(f'Loaded {len(self)} prefixes into the prefix index')
+
+    def run(self, db, poll_interval=POLL_INTERVAL, retry_interval=RETRY_INTERVAL):
+        """Load the index and keep it current, forever; start it in a daemon
+        thread.  If Mongo is unreachable, or the stream or polling fails,
+        mark the index unloaded, so lookups fall back to Mongo instead of
+        trusting a frozen index, and load it again once Mongo is back."""
+        while True:
+            try:
+                self.follow(db, poll_interval)
+            except PyMongoError as err:
+                self.loaded = False
+                logging.warning(f'Prefix index lost the bgp collection ({err}), reloading in {retry_interval}s')
+                time.sleep(retry_interval)
+
+    def follow(self, db, poll_interval):
+        """Load the index, then apply a change stream on the bgp collection.
+        Mongo only offers change streams on replica sets, so on a standalone
+        server poll for prefixes whose *updated* time moved instead."""
+        try:
+            with db.bgp.watch([{'$match': {'operationType': {'$in': ['insert', 'replace', 'update', 'delete']}}}]) as stream:
+                self.load(db)
+                for change in stream:
+                    self.apply_change(change)
+        except OperationFailure as err:
+            logging.info(f'No change stream on the bgp collection ({err}), polling every {poll_interval}s')
+            self.poll(db, poll_interval)
+
+    def apply_change(self, change):
+        prefix = change['documentKey']['_id']
+        if change['operationType'] == 'delete':
+            self.remove(prefix)
+        elif change['operationType'] == 'update':
+            updated_fields = change['updateDescription']['updatedFields']
+            if 'active' in updated_fields:
+                self.apply(prefix, updated_fields['active'])
+        else:
+            self.apply(prefix, change['fullDocument'].get('active'))
+
+    def poll(self, db, poll_interval):
+        """Reload the index, then apply the active state of every prefix
+        written since the newest *updated* time seen.  Writes sharing that
+        time are read again, which is harmless.  Mongo errors are raised to
+        run(), which reloads."""
+        newest = db.bgp.find_one({'updated': {'$exists': True}}, {'updated': 1}, sort=[('updated', DESCENDING)])
+        since = newest['updated'] if newest else None
+        self.load(db)
+        while True:
+            time.sleep(poll_interval)
+            for prefix in db.bgp.find({'updated': {'$gte': since}} if since else {'updated': {'$exists': True}},
+                                      {'active': 1, 'updated': 1}):
+                self.apply(prefix['_id'], prefix.get('active'))
+                since = max(since, prefix['updated']) if since else prefix['updated']
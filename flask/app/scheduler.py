@@ -0,0 +1,86 @@
+import time
+import logging
+import threading
+
+COST_FACTOR = 5  # A job waits at least this many times its last run time, so it uses at most a fifth of a thread
+CHURN_REFERENCE = 10  # Updates per second from which jobs run at their base interval; quieter tables stretch it
+
+
+class Job(object):
+    """A function run every *interval* seconds, stretched towards
+    *max_interval* while the table is quiet and never sooner than
+    COST_FACTOR times its last run time."""
+
+    def __init__(self, name, func, interval, max_interval=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.max_interval = max_interval or interval
+        self.next_interval = interval
+        self.cost = 0  # seconds the last run took
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            self.func()
+        except Exception:
+            self.failures += 1
+            logging.exception(f'Stats job {self.name} failed')
+        self.cost = time.perf_counter() - started
+        self.runs += 1
+        self.last_run = time.time()
+
+    def schedule(self, churn=None):
+        """Return the seconds until the next run, given the ingester's
+        *churn* in updates per second (None if unknown)."""
+        interval = self.interval
+        if churn is not None and churn < CHURN_REFERENCE:
+            interval = min(self.interval * CHURN_REFERENCE / max(churn, 1), self.max_interval)
+        self.next_interval = max(interval, self.cost * COST_FACTOR)
+        return self.next_interval
+
+    def stats(self):
+        return {'interval': self.interval,
+                'max_interval': self.max_interval,
+                'next_interval': round(self.next_interval, 3),
+                'cost': round(self.cost, 4),
+                'runs': self.runs,
+                'failures': self.failures,
+                'last_run': self.last_run}
+
+
+class Scheduler(object):
+    """Run each job in a daemon thread of its own: run it, measure it, wait
+    its next interval, repeat.  A job never overlaps itself, and a run that
+    falls due while the last one is still going waits for it and runs once,
+    instead of piling up.  *churn* is a callable returning the ingester's
+    updates per second, or None."""
+
+    def __init__(self, churn=None):
+        self.churn = churn
+        self.jobs = {}
+
+    def add_job(self, name, func, interval, max_interval=None):
+        self.jobs[name] = Job(name, func, interval, max_interval)
+
+    def start(self):
+        for job in self.jobs.values():
+            threading.Thread(target=self.loop, args=(job,), name=f'stats-{job.name}', daemon=True).start()
+
+    def loop(self, job):
+        while True:
+            job.run()
+            churn = None
+            if self.churn is not None:
+                try:
+                    churn = self.churn()
+                except Exception as err:
+                    logging.warning(f'Could not read the ingest churn: {err}')
+            time.sleep(job.schedule(churn))
+
+    def stats(self):
+        """Return each job's intervals, last cost and run counts."""
+        return {name: job.stats() for name, job in self.jobs.items()}
@@ -0,0 +1,28 @@
+import gzip
+import hashlib
+import json
+
+
+def encode(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+class Snapshot(object):
+    """An immutable, serialized copy of some dashboard data.  The JSON and
+    its gzip are built once, when the snapshot is published, so serving it
+    costs no encoding; the ETag is a hash of the JSON, so every worker
+    gives the same data the same tag."""
+
+    def __init__(self, data, version=1):
+        self.data = data
+        self.version = version  # bumped each time the data changes
+        self.body = encode(data)
+        self.gzipped = gzip.compress(self.body, compresslevel=6)
+        self.etag = hashlib.sha1(self.body).hexdigest()[:20]
+
+    def __len__(self):
+        return len(self.body)
+
+    def replace(self, data):
+        """Return a snapshot of *data*, or this one if the data is unchanged."""
+        return self if encode(data) == self.body else Snapshot(data, self.version + 1)
@@ -1,176 +1,710 @@
 #! /usr/bin/env python3
 
+import os
 import sys
-import json
+import argparse
+import multiprocessing
+import queue
+import threading
+import time
 import bgp_attributes as BGP
-from pymongo import MongoClient
+from rib_shadow import RibShadow, route_fingerprint
+from flap_damping import FlapDamping
+from ingest_metrics import IngestMetrics
+from route_counters import RouteCounters
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
 import pymongo
-from copy import copy
-from datetime import datetime
-import ipaddress
+from collections import OrderedDict
+from datetime import datetime, timezone
 import logging
+from functools import lru_cache
+try:  # use the fastest JSON decoder available
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from simdjson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+# Searched last, so the Flask app's modules never shadow installed packages
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask', 'app'))
+import mongo  # noqa: E402  the pooled client shared with the Flask app
 # logging.basicConfig(level=logging.CRITICAL)
 # logging.basicConfig(level=logging.DEBUG)
 
 # DEFAULTS - UPDATE ACCORDINGLY
-MAX_PREFIX_HISTORY = 100  # None = unlimited (BGP flapping will likely kill DB if unlimited)
+MAX_PREFIX_HISTORY = 100  # History entries kept per prefix. None = unlimited (BGP flapping will likely fill the DB)
+HISTORY_TTL = None  # Seconds to keep history entries before Mongo expires them. None = keep
+HISTORY_TRIM_INTERVAL = 60  # Seconds between trims of prefixes over MAX_PREFIX_HISTORY
+BATCH_SIZE = 1000  # Max prefixes buffered before a bulk write (1 = write every update on its own)
+FLUSH_INTERVAL = 1.0  # Max seconds an update may wait in the buffer before it is written
+REPORT_INTERVAL = 60  # Seconds between throughput reports
+STATS_INTERVAL = 10  # Seconds between writes of the ingest_stats document (0 = off)
+METRICS_PORT = 0  # Port serving Prometheus metrics at /metrics (0 = off)
+WORKERS = 0  # Processes decoding GoBGP output (0 = decode in the main process)
+CHUNK_SIZE = 500  # Lines handed to a decoding process at a time
+COALESCE_WINDOW = 0  # Seconds to hold each prefix and write only its final state (0 = off)
+SWEEP_IDLE = 30  # Seconds without a prefix new to this session after which the initial table dump is considered complete
+SWEEP_MAX_WAIT = 600  # Seconds after which the initial table dump is considered complete anyway
+WRITE_CONCERN = 1  # w for ingest writes: a number of members or 'majority'
+RECONCILE_INTERVAL = 3600  # Seconds between rebuilds of bgp_counters from the RIB shadow
+
+# Indexes created by older versions and since replaced: the *_active_2 ones used pymongo.ALL (2)
+# as a direction, and nexthop_asn_1_active_1 is a prefix of nexthop_asn_1_active_1__id_1.
+LEGACY_INDEXES = ('nexthop_1_active_2', 'nexthop_asn_1_active_2', 'ip_version_1_active_2',
+                  'origin_asn_1_ip_version_1_active_2', 'communities_1_active_2',
+                  'as_path.1_1_nexthop_asn_1_active_2', 'nexthop_asn_1_active_1')
 
 
-def db_connect(host='mongodb'):
-    """Return a connection to the Mongo Database."""
-    client = MongoClient(host=host)
-    return client.bgp
+def db_connect(host='mongodb', write_concern=WRITE_CONCERN):
+    """Return the Mongo Database on the process's pooled client."""
+    mongo.configure(host=host, write_concern=write_concern)
+    return mongo.get_db()
 
 
 def initialize_database(db):
-    """Create indxes, and if the db contains any entries set them all to 'active': False"""
+    """Create indxes and migrate data written by older versions."""
     # db.bgp.drop()
+    existing = db.bgp.index_information()
+    for name in LEGACY_INDEXES:
+        if name in existing:
+            db.bgp.drop_index(name)
+            logging.info(f'Dropped legacy index bgp.{name}')
     db.bgp.create_index('nexthop')
     db.bgp.create_index('nexthop_asn')
-    db.bgp.create_index([('nexthop', pymongo.ASCENDING), ('active', pymongo.ALL)])
-    db.bgp.create_index([('nexthop_asn', pymongo.ASCENDING), ('active', pymongo.ALL)])
-    db.bgp.create_index([('ip_version', pymongo.ASCENDING), ('active', pymongo.ALL)])
-    db.bgp.create_index([('origin_asn', pymongo.ASCENDING), ('ip_version', pymongo.ASCENDING), ('active', pymongo.ALL)])
-    db.bgp.create_index([('communities', pymongo.ASCENDING), ('active', pymongo.ALL)])
-    db.bgp.create_index([('as_path.1', pymongo.ASCENDING), ('nexthop_asn', pymongo.ASCENDING), ('active', pymongo.ALL)])
-    db.bgp.update_many(
-        {"active": True},  # Search for
-        {"$set": {"active": False}})  # Replace with
+    db.bgp.create_index([('nexthop', pymongo.ASCENDING), ('active', pymongo.ASCENDING)])
+    db.bgp.create_index([('nexthop_asn', pymongo.ASCENDING), ('active', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    db.bgp.create_index([('origin_asn', pymongo.ASCENDING), ('active', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    db.bgp.create_index([('ip_version', pymongo.ASCENDING), ('active', pymongo.ASCENDING)])
+    db.bgp.create_index([('origin_asn', pymongo.ASCENDING), ('ip_version', pymongo.ASCENDING), ('active', pymongo.ASCENDING)])
+    db.bgp.create_index([('communities', pymongo.ASCENDING), ('active', pymongo.ASCENDING)])
+    db.bgp.create_index([('as_path.1', pymongo.ASCENDING), ('nexthop_asn', pymongo.ASCENDING), ('active', pymongo.ASCENDING)])
+    db.bgp.create_index([('as_path', pymongo.ASCENDING), ('active', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    db.bgp_history.create_index([('prefix', pymongo.ASCENDING), ('timestamp', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+    if HISTORY_TTL is not None:
+        db.bgp_history.create_index('timestamp', expireAfterSeconds=HISTORY_TTL)
+    db.bgp.create_index([('generation', pymongo.ASCENDING), ('active', pymongo.ASCENDING)])
+    db.bgp.create_index([('flap_penalty', pymongo.DESCENDING)], sparse=True)
+    db.bgp.create_index('updated')
+    db.bgp_counters.create_index([('kind', pymongo.ASCENDING), ('count', pymongo.ASCENDING)])
+    migrate_embedded_history(db)
+    db.bgp.update_many({'generation': {'$exists': False}}, {'$set': {'generation': 0}})
+
+
+def next_generation(db):
+    """Return a new ingester session generation, higher than all before it."""
+    state = db.ingest_state.find_one_and_update({'_id': 'generation'}, {'$inc': {'value': 1}},
+                                                upsert=True, return_document=ReturnDocument.AFTER)
+    return state['value']
+
+
+def age_to_datetime(age):
+    """Given the *age* string stored on a prefix, return it as a UTC datetime."""
+    try:
+        return datetime.strptime(age, '%Y-%m-%d %H:%M:%S UTC').replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):  # no age from GoBGP
+        return datetime.now(timezone.utc)
+
+
+def history_document(history_entry, timestamp):
+    """Return the bgp_history document for a superseded route.  *timestamp* is
+    when it was replaced; the route's own *_id* is stored as *prefix*."""
+    document = {key: value for key, value in history_entry.items() if key != '_id'}
+    document['prefix'] = history_entry['_id']
+    document['timestamp'] = timestamp
+    return document
+
+
+def migrate_embedded_history(db):
+    """Move history arrays embedded in bgp documents by older versions into
+    the bgp_history collection."""
+    for prefix in db.bgp.find({'history.0': {'$exists': True}}, {'history': 1}):
+        db.bgp_history.insert_many([history_document(dict(entry, _id=prefix['_id']), age_to_datetime(entry.get('age')))
+                                    for entry in reversed(prefix['history'])], ordered=False)
+    db.bgp.update_many({'history': {'$exists': True}}, {'$unset': {'history': ''}})
+
+
+def over_history_limit(db, prefixes, max_history=MAX_PREFIX_HISTORY, chunk_size=10000):
+    """Return those of *prefixes* with more than *max_history* history
+    entries, counted with one $group per *chunk_size* prefixes on the prefix
+    index instead of one query per prefix."""
+    prefixes = list(prefixes)
+    over = []
+    for start in range(0, len(prefixes), chunk_size):
+        over.extend(counted['_id'] for counted in db.bgp_history.aggregate([
+            {'$match': {'prefix': {'$in': prefixes[start:start + chunk_size]}}},
+            {'$group': {'_id': '$prefix', 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': max_history}}}]))
+    return over
+
+
+def trim_history(db, prefixes, max_history=MAX_PREFIX_HISTORY):
+    """Delete all but the newest *max_history* history entries of *prefixes*.
+    Entries replaced at the same time are ordered by insertion (_id).  Only
+    prefixes over the limit are queried one by one."""
+    newest_first = [('timestamp', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+    for prefix in over_history_limit(db, prefixes, max_history):
+        oldest_kept = list(db.bgp_history.find({'prefix': prefix}, {'timestamp': 1})
+                           .sort(newest_first).skip(max_history - 1).limit(1))
+        if oldest_kept:
+            timestamp, _id = oldest_kept[0]['timestamp'], oldest_kept[0]['_id']
+            db.bgp_history.delete_many({'prefix': prefix, '$or': [{'timestamp': {'$lt': timestamp}},
+                                                                  {'timestamp': timestamp, '_id': {'$lt': _id}}]})
 
 
 def get_update_entry(line):
     """Read output from GoBGP from stdin and return a update entry *dict*"""
     try:
-        update_list = json.loads(line)
+        update_list = json_loads(line)
         for update_entry in update_list:
             if 'error' in update_entry:
                 return None
             else:
                 return(update_entry)
     except Exception as err:
-        logging.error("Error in get_update_entry(line):", err)
+        logging.error(f'Error in get_update_entry(line): {err}')
         return None
 
 
-def compare_prefixes(new, old):
-    """ignore history, age, and active state, then compare prefix objects"""
-    new['history'] = new['age'] = new['active'] = None
-    old['history'] = old['age'] = old['active'] = None
-    if new == old:
-        return True
-    else:
-        return False
-
-
 def community_32bit_to_string(number):
     """Given a 32bit number, convert to standard bgp community format XXX:XX"""
-    if number is not 0:
-        return f'{int(bin(number)[:-16], 2)}:{int(bin(number)[-16:], 2)}'  # PEP 498
+    if number != 0:
+        return f'{number >> 16}:{number & 0xFFFF}'  # PEP 498
+
+
+@lru_cache(maxsize=4096)
+def age_to_string(age):
+    """Given a GoBGP *age* epoch, return the string stored on the prefix.
+    Cached, since a dump carries the same few ages on many lines."""
+    return datetime.fromtimestamp(age).strftime('%Y-%m-%d %H:%M:%S ') + 'UTC'
+
+
+def decode_origin(attribute, update_json):
+    update_json['route_origin'] = BGP.ORIGIN_CODE[attribute['value']]
+
+
+def decode_as_path(attribute, update_json):
+    try:
+        as_path = attribute['as_paths'][0]['asns']
+        update_json['nexthop_asn'] = as_path[0]
+        update_json['origin_asn'] = as_path[-1]
+        update_json['as_path'] = as_path
+    except Exception:
+        logging.debug(f'Error processing as_path: {attribute}')
+        logging.debug(f'Error processing as_path: {update_json["_id"]}')
+
+
+def decode_nexthop(attribute, update_json):
+    update_json['nexthop'] = attribute['nexthop']
+
+
+def decode_med(attribute, update_json):
+    try:
+        update_json['med'] = attribute['metric']
+    except Exception:
+        logging.debug(f'Error processing med: {attribute}')
+
+
+def decode_local_pref(attribute, update_json):
+    try:
+        update_json['local_pref'] = attribute['value']
+    except Exception:
+        logging.debug(f'Error processing local_pref: {attribute}')
+
+
+def decode_atomic_aggregate(attribute, update_json):
+    update_json['atomic_aggregate'] = True
+
+
+def decode_aggregator(attribute, update_json):
+    update_json['aggregator_as'] = attribute['as']
+    update_json['aggregator_address'] = attribute['address']
+
+
+def decode_communities(attribute, update_json):
+    try:
+        update_json['communities'].extend(map(community_32bit_to_string, attribute['communities']))
+    except Exception:
+        logging.debug(f'Error processing communities: {attribute}')
+
+
+def decode_originator_id(attribute, update_json):
+    update_json['originator_id'] = attribute['value']
+
+
+def decode_cluster_list(attribute, update_json):
+    update_json['cluster_list'] = attribute['value']
+
+
+def decode_ignored(attribute, update_json):
+    logging.debug(f'Found attribute type {attribute["type"]}: {attribute}')
+
+
+# BGP attribute type -> function setting its keys on the update json
+ATTRIBUTE_DECODERS = {
+    BGP.ORIGIN: decode_origin,
+    BGP.AS_PATH: decode_as_path,
+    BGP.NEXT_HOP: decode_nexthop,
+    BGP.MULTI_EXIT_DISC: decode_med,
+    BGP.LOCAL_PREF: decode_local_pref,
+    BGP.ATOMIC_AGGREGATE: decode_atomic_aggregate,
+    BGP.AGGREGATOR: decode_aggregator,
+    BGP.COMMUNITY: decode_communities,
+    BGP.ORIGINATOR_ID: decode_originator_id,
+    BGP.CLUSTER_LIST: decode_cluster_list,
+    BGP.MP_REACH_NLRI: decode_nexthop,
+    BGP.MP_UNREACH_NLRI: decode_ignored,
+    BGP.EXTENDED_COMMUNITIES: decode_ignored,
+}
+
+ROUTE_DEFAULTS = {
+    'origin_asn': None,
+    'nexthop': None,
+    'nexthop_asn': None,
+    'med': 0,
+    'local_pref': 0,
+    'route_origin': None,
+    'atomic_aggregate': None,
+    'aggregator_as': None,
+    'aggregator_address': None,
+    'originator_id': None,
+    'withdrawal': False,
+    'age': 0,
+    'active': True
+}
 
 
 def build_json(update_entry):
     """Given an update entry from GoBGP, set the BGP attribue types as a
     key/value dict and return"""
-    update_json = {  # set defaults
-        '_id': update_entry['nlri']['prefix'],
-        'ip_version': ipaddress.ip_address(update_entry['nlri']['prefix'].split('/', 1)[0]).version,
-        'origin_asn': None,
-        'nexthop': None,
-        'nexthop_asn': None,
-        'as_path': [],
-        'med': 0,
-        'local_pref': 0,
-        'communities': [],
-        'route_origin': None,
-        'atomic_aggregate': None,
-        'aggregator_as': None,
-        'aggregator_address': None,
-        'originator_id': None,
-        'cluster_list': [],
-        'withdrawal': False,
-        'age': 0,
-        'active': True,
-        'history': []
-    }
+    prefix = update_entry['nlri']['prefix']
+    update_json = {'_id': prefix, 'ip_version': 6 if ':' in prefix else 4}
+    update_json.update(ROUTE_DEFAULTS)  # set defaults, with fresh lists below
+    update_json['as_path'] = []
+    update_json['communities'] = []
+    update_json['cluster_list'] = []
     for attribute in update_entry['attrs']:
-        if attribute['type'] == BGP.ORIGIN:
-            update_json['route_origin'] = BGP.ORIGIN_CODE[attribute['value']]
-        if attribute['type'] == BGP.AS_PATH:
-            try:
-                update_json['as_path'] = attribute['as_paths'][0]['asns']
-                update_json['nexthop_asn'] = update_json['as_path'][0]
-                update_json['origin_asn'] = update_json['as_path'][-1]
-            except Exception:
-                logging.debug(f'Error processing as_path: {attribute}')
-                logging.debug(f'Error processing as_path: {update_json["_id"]}')
-        if attribute['type'] == BGP.NEXT_HOP:
-            update_json['nexthop'] = attribute['nexthop']
-        if attribute['type'] == BGP.MULTI_EXIT_DISC:
-            try:
-                update_json['med'] = attribute['metric']
-            except Exception:
-                logging.debug(f'Error processing med: {attribute}')
-        if attribute['type'] == BGP.LOCAL_PREF:
-            try:
-                update_json['local_pref'] = attribute['value']
-            except Exception:
-                logging.debug(f'Error processing local_pref: {attribute}')
-        if attribute['type'] == BGP.ATOMIC_AGGREGATE:
-            update_json['atomic_aggregate'] = True
-        if attribute['type'] == BGP.AGGREGATOR:
-            update_json['aggregator_as'] = attribute['as']
-            update_json['aggregator_address'] = attribute['address']
-        if attribute['type'] == BGP.COMMUNITY:
-            try:
-                for number in attribute['communities']:
-                    update_json['communities'].append(community_32bit_to_string(number))
-            except Exception:
-                logging.debug(f'Error processing communities: {attribute}')
-        if attribute['type'] == BGP.ORIGINATOR_ID:
-            update_json['originator_id'] = attribute['value']
-        if attribute['type'] == BGP.CLUSTER_LIST:
-            update_json['cluster_list'] = attribute['value']
-        if attribute['type'] == BGP.MP_REACH_NLRI:
-            update_json['nexthop'] = attribute['nexthop']
-        if attribute['type'] == BGP.MP_UNREACH_NLRI:
-            logging.debug(f'Found MP_UNREACH_NLRI: {attribute}')
-        if attribute['type'] == BGP.EXTENDED_COMMUNITIES:
-            logging.debug(f'Found EXTENDED_COMMUNITIES: {attribute}')
+        decoder = ATTRIBUTE_DECODERS.get(attribute['type'])
+        if decoder is not None:
+            decoder(attribute, update_json)
     if 'withdrawal' in update_entry:
         update_json['withdrawal'] = update_entry['withdrawal']
         update_json['active'] = False
     if 'age' in update_entry:
-        update_json['age'] = datetime.fromtimestamp(update_entry['age']).strftime('%Y-%m-%d %H:%M:%S ') + 'UTC'
+        update_json['age'] = age_to_string(update_entry['age'])
+    update_json['fingerprint'] = route_fingerprint(update_json)
 
     return update_json
 
 
-def update_prefix(prefix_from_gobgp, prefix_from_database):
-    if compare_prefixes(copy(prefix_from_gobgp), copy(prefix_from_database)):
-        prefix_from_gobgp['active'] = True  # flip the active state to true
-    else:  # diff between prefix_from_gobgp and prefix_from_database: update history
-        history_list = prefix_from_database['history']
-        del prefix_from_database['active']  # delete house keeping keys from history objects
-        del prefix_from_database['history']
-        if not history_list:  # no history: create some
-            prefix_from_gobgp['history'].append(prefix_from_database)
-        else:  # existing history: append to history list
-            history_list.insert(0, prefix_from_database)  # insert on top of list, index 0
-            prefix_from_gobgp['history'] = history_list[:MAX_PREFIX_HISTORY]  # trim the history list if MAX is set
-    return prefix_from_gobgp
+def update_prefix(prefix_from_gobgp, prefix_from_rib):
+    """Compare a new prefix from GoBGP with the last version written.  Return
+    the history entry to record for *prefix_from_rib*, or None if only the
+    age or active state changed.  Neither argument is modified."""
+    if prefix_from_gobgp['fingerprint'] == prefix_from_rib['fingerprint']:
+        return None
+    return {key: value for key, value in prefix_from_rib.items()  # drop house keeping keys from history objects
+            if key not in ('active', 'fingerprint')}
+
+
+def fold_updates(updates, prefix_from_rib):
+    """Apply *updates* for one prefix in order on top of *prefix_from_rib*.
+    Return the latest prefix and the bgp_history documents it adds, oldest
+    first."""
+    history = []
+    current = prefix_from_rib
+    for prefix_from_gobgp in updates:
+        if current is not None:
+            history_entry = update_prefix(prefix_from_gobgp, current)
+            if history_entry is not None:
+                history.append(history_document(history_entry, age_to_datetime(prefix_from_gobgp['age'])))
+        current = prefix_from_gobgp
+    return current, history
+
+
+class BatchWriter(object):
+    """Buffer prefixes from GoBGP and write them to Mongo with one bulk_write
+    per batch.  A batch is flushed when it holds *batch_size* prefixes or when
+    its oldest update has waited *flush_interval* seconds.
+
+    With a *coalesce_window*, each prefix is instead held for that many
+    seconds after its first update (or until *batch_size* prefixes are
+    buffered), and only its final state is written:
+    the states it passed through in between are counted as flaps but are
+    not written or added to history."""
+
+    def __init__(self, db, rib, generation=0, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 coalesce_window=COALESCE_WINDOW, report_interval=REPORT_INTERVAL, stats_interval=STATS_INTERVAL,
+                 metrics=None):
+        if not flush_interval > 0:  # the decode loop waits flush_interval / 2 for input, so 0 would spin
+            raise ValueError(f'flush_interval must be positive, not {flush_interval}')
+        self.db = db
+        self.rib = rib
+        self.generation = generation  # stamped on every route written by this session
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.coalesce_window = coalesce_window
+        self.report_interval = report_interval
+        self.stats_interval = stats_interval
+        self.pending = OrderedDict()  # prefix -> updates for that prefix, oldest first
+        self.held_since = {}  # prefix -> time its first pending update arrived
+        self.flaps = {}  # prefix -> flaps seen since it was last written
+        self.damping = FlapDamping()
+        self.untrimmed = set()  # prefixes with history appended since the last trim
+        self.last_trim = time.time()
+        self.counters = RouteCounters()
+        self.last_reconcile = 0  # reconcile on the first tick
+        self.metrics = IngestMetrics() if metrics is None else metrics
+        self.metrics.set('generation', generation)
+        self.last_stamped = time.monotonic()  # last update of a prefix not yet stamped with *generation*
+        self.started = self.last_report = self.last_stats = time.time()
+
+    def add(self, prefix_from_gobgp):
+        """Queue an update, flushing first if the batch is full.  A change of
+        attributes or of announced/withdrawn state counts as a flap."""
+        _id = prefix_from_gobgp['_id']
+        updates = self.pending.get(_id)
+        if updates:
+            previous = updates[-1]['fingerprint'], updates[-1]['withdrawal']
+        else:
+            previous = self.rib.state(_id)
+        if previous is not None and previous[0] != prefix_from_gobgp['fingerprint']:
+            self.flaps[_id] = self.flaps.get(_id, 0) + 1
+            self.damping.record(_id, prefix_from_gobgp['withdrawal'], previous[1])
+            self.metrics.inc('flaps')
+        if updates is None:
+            self.pending[_id] = [prefix_from_gobgp]
+            self.held_since[_id] = time.monotonic()
+            if self.rib.generation(_id) != self.generation:
+                self.last_stamped = self.held_since[_id]
+        elif self.coalesce_window:
+            updates[-1] = prefix_from_gobgp
+        else:
+            updates.append(prefix_from_gobgp)
+        self.metrics.inc('updates')
+        if prefix_from_gobgp['withdrawal']:
+            self.metrics.inc('withdrawals')
+        if len(self.pending) >= self.batch_size or self.time_left() == 0:
+            self.flush()
+
+    def time_left(self):
+        """Seconds until the oldest pending prefix must be written, None if
+        nothing is pending."""
+        if not self.pending:
+            return None
+        wait = self.coalesce_window or self.flush_interval
+        return max(0, wait - (time.monotonic() - self.held_since[next(iter(self.pending))]))
+
+    def ready(self, force=False):
+        """Return the pending prefixes due to be written, oldest first and at
+        most *batch_size* of them, or all of them if *force*.  A prefix held
+        for a coalesce window is due when its window ends, or early once
+        *batch_size* prefixes are buffered, so the window never lets the
+        buffer grow past a batch."""
+        if force:
+            return list(self.pending)
+        held_until = time.monotonic() - self.coalesce_window
+        full = len(self.pending) >= self.batch_size
+        ready = []
+        for _id in self.pending:
+            if len(ready) == self.batch_size or (not full and self.held_since[_id] > held_until):
+                break
+            ready.append(_id)
+        return ready
+
+    def flush(self, force=False):
+        """Write the pending prefixes that are due, or all of them if *force*.
+        Every prefix appears once per batch (the latest update wins, earlier
+        ones are appended to bgp_history), so the writes are independent and
+        can be sent unordered.  The previous version of each prefix comes from
+        the RIB shadow, not from Mongo."""
+        ready = self.ready(force)
+        if ready:
+            requests = []
+            history = []
+            written = []
+            now = datetime.now(timezone.utc)  # stamped as *updated* so readers can poll for changes
+            for _id in ready:
+                updates = self.pending.pop(_id)
+                del self.held_since[_id]
+                prefix_from_rib = self.rib.get(_id)
+                latest, prefix_history = fold_updates(updates, prefix_from_rib)
+                latest['generation'] = self.generation
+                latest['updated'] = now
+                if prefix_from_rib is not None and not prefix_history:  # unchanged attributes: refresh age only
+                    update = {'$set': {'age': latest['age'],
+                                       'active': latest['active'],
+                                       'fingerprint': latest['fingerprint'],
+                                       'generation': self.generation,
+                                       'updated': now}}
+                else:  # new prefix, or known prefix with new attributes
+                    update = {'$set': {key: value for key, value in latest.items() if key != '_id'}}
+                flaps = self.flaps.pop(_id, 0)
+                if flaps:
+                    penalty, damped = self.damping.get(_id)
+                    update['$set'].update({'flap_penalty': round(penalty),
+                                           'flap_updated': now,
+                                           'damped': damped})
+                    update['$inc'] = {'flap_count': flaps}
+                if prefix_from_rib is None and '$inc' not in update:  # new prefix: write the whole document
+                    requests.append(ReplaceOne({'_id': _id}, latest, upsert=True))
+                else:
+                    requests.append(UpdateOne({'_id': _id}, update, upsert=prefix_from_rib is None))
+                if prefix_history:
+                    history.extend(prefix_history)
+                    self.untrimmed.add(_id)
+                written.append(latest)
+                if (prefix_from_rib is None or prefix_from_rib['fingerprint'] != latest['fingerprint']
+                        or prefix_from_rib['active'] != latest['active']):
+                    self.counters.change(prefix_from_rib, latest)
+            with self.metrics.timer('bgp.bulk_write'):
+                self.db.bgp.bulk_write(requests, ordered=False)
+            if history:
+                with self.metrics.timer('bgp_history.insert_many'):
+                    self.db.bgp_history.insert_many(history, ordered=False)
+            if self.counters:
+                with self.metrics.timer('bgp_counters.bulk_write'):
+                    self.counters.write(self.db)
+            for prefix in written:
+                self.rib.set(prefix)
+            self.metrics.inc('writes', len(requests))
+            self.metrics.inc('history_appends', len(history))
+            self.metrics.inc('flushes')
+            ages = [prefix['age'] for prefix in written if prefix['age']]  # 'YYYY-MM-DD HH:MM:SS UTC' sorts by time
+            if ages:
+                newest = age_to_datetime(max(ages))
+                self.metrics.set('route_age_lag_seconds', round(time.time() - newest.timestamp(), 3))
+        self.tick()
+
+    def tick(self):
+        """Run the periodic history trim, throughput report and stats write
+        when they are due.  Called after every flush and on idle chunks."""
+        now = time.time()
+        if now - self.last_trim >= HISTORY_TRIM_INTERVAL:
+            self.trim()
+        if now - self.last_report >= self.report_interval:
+            self.report()
+        if self.stats_interval and now - self.last_stats >= self.stats_interval:
+            self.write_stats()
+        if now - self.last_reconcile >= RECONCILE_INTERVAL:
+            self.reconcile()
+
+    def sweep(self):
+        """Deactivate every route not re-announced by this session.  Called once
+        the initial table dump is complete."""
+        self.flush(force=True)
+        stale = self.rib.stale(self.generation)
+        if stale:
+            with self.metrics.timer('bgp.sweep'):
+                self.db.bgp.update_many({'generation': {'$lt': self.generation}, 'active': True},
+                                        {'$set': {'active': False, 'updated': datetime.now(timezone.utc)}})
+            self.counters.deactivate(self.rib, stale)
+            self.counters.write(self.db)
+            self.rib.deactivate(stale)
+        logging.info(f'Initial table loaded, retired {len(stale)} routes from older generations')
+
+    def trim(self):
+        """Enforce MAX_PREFIX_HISTORY on prefixes that gained history, and
+        forget flap penalties that have decayed."""
+        if MAX_PREFIX_HISTORY is not None and self.untrimmed:
+            with self.metrics.timer('bgp_history.trim'):
+                trim_history(self.db, self.untrimmed, MAX_PREFIX_HISTORY)
+        self.untrimmed = set()
+        self.damping.expire()
+        self.last_trim = time.time()
+
+    def reconcile(self):
+        """Rebuild the bgp_counters collection from the RIB shadow."""
+        with self.metrics.timer('bgp_counters.reconcile'):
+            self.counters.reconcile(self.db, self.rib)
+        self.last_reconcile = time.time()
+
+    def update_gauges(self):
+        self.metrics.set('pending_prefixes', len(self.pending))
+        self.metrics.set('rib_routes', len(self.rib))
+        self.metrics.set('flapping_prefixes', len(self.damping))
+        self.metrics.set('damped_prefixes', self.damping.damped_count())
+
+    def report(self):
+        """Log the throughput since startup."""
+        self.update_gauges()
+        counters = self.metrics.counters
+        elapsed = max(time.time() - self.started, 1e-9)
+        logging.info(f'{counters["lines_read"]} lines ({counters["parse_failures"]} unparsed), '
+                     f'{counters["updates"]} updates ({counters["updates"] / elapsed:.0f}/s), '
+                     f'{counters["writes"]} writes ({counters["writes"] / elapsed:.0f}/s), '
+                     f'{counters["history_appends"]} history entries in '
+                     f'{counters["flushes"]} batches ({counters["writes"] / max(counters["flushes"], 1):.1f} prefixes/batch), '
+                     f'{len(self.damping)} flapping prefixes ({self.damping.damped_count()} damped), '
+                     f'RIB shadow {len(self.rib)} routes/{len(self.rib.interned)} shared values, '
+                     f'route age lag {self.metrics.gauges.get("route_age_lag_seconds", 0):.0f}s')
+        self.last_report = time.time()
+
+    def write_stats(self):
+        """Replace the ingester's document in the ingest_stats collection."""
+        self.update_gauges()
+        document = self.metrics.document()
+        document['mongo_commands'] = mongo.timings.summary()
+        self.db.ingest_stats.replace_one({'_id': document['_id']}, document, upsert=True)
+        self.last_stats = time.time()
+
+
+def read_lines(stream, lines, metrics=None):
+    """Put every line of *stream* on the *lines* queue, then None at EOF."""
+    for line in stream:
+        lines.put(line)
+        if metrics is not None:
+            metrics.inc('lines_read')
+    lines.put(None)
+
+
+def iter_chunks(lines, chunk_size, timeout, in_flight=None):
+    """Yield lists of up to *chunk_size* lines from the *lines* queue.  A
+    chunk is cut short after *timeout* seconds, so an idle stream yields
+    empty chunks that let the writer flush on time.  If *in_flight* is a
+    semaphore, it is acquired before each chunk to bound read-ahead."""
+    done = False
+    while not done:
+        if in_flight is not None:
+            in_flight.acquire()
+        chunk = []
+        deadline = time.monotonic() + timeout
+        while len(chunk) < chunk_size:
+            try:
+                line = lines.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if line is None:
+                done = True
+                break
+            chunk.append(line)
+        yield chunk
+
+
+def decode_lines(lines):
+    """Decode a chunk of GoBGP output lines into prefix dicts, in order.  Runs
+    in the worker processes when --workers is set.  Return the prefixes and
+    the number of non-blank lines that did not decode to an update."""
+    prefixes = []
+    failures = 0
+    for line in lines:
+        update_entry = get_update_entry(line)
+        if update_entry:
+            prefixes.append(build_json(update_entry))
+        elif line.strip():
+            failures += 1
+    return prefixes, failures
+
+
+def ingest(db, rib, stream, generation=0, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+           workers=WORKERS, chunk_size=CHUNK_SIZE, sweep_idle=SWEEP_IDLE, coalesce_window=COALESCE_WINDOW,
+           writer=None, metrics=None, sweep_max_wait=SWEEP_MAX_WAIT):
+    """Read GoBGP updates from *stream* and write them to Mongo in batches.
+    With *workers*, chunks of lines are decoded by a process pool; imap()
+    returns the chunks in input order, so updates for a prefix reach the
+    writer in the order GoBGP sent them.
+
+    Routes are stamped with *generation*.  When no prefix has been stamped
+    for the first time in *sweep_idle* seconds, *sweep_max_wait* seconds
+    have passed, or the stream ends, the initial dump is done, and routes
+    from older generations are swept once.  Updates to prefixes already
+    stamped do not count, so a busy live feed cannot hold the sweep off.
+    A prebuilt *writer*
+    replaces the BatchWriter made from the arguments above, and *metrics*
+    the IngestMetrics it counts into."""
+    if writer is None:
+        writer = BatchWriter(db, rib, generation, batch_size, flush_interval, coalesce_window, metrics=metrics)
+    metrics = writer.metrics
+    lines = queue.Queue(maxsize=chunk_size * 4)
+    threading.Thread(target=read_lines, args=(stream, lines, metrics), daemon=True).start()
+    in_flight = threading.BoundedSemaphore(max(workers, 1) * 4)
+    wait = min(writer.flush_interval, writer.coalesce_window or writer.flush_interval) / 2
+    chunks = iter_chunks(lines, chunk_size, wait, in_flight)
+    pool = multiprocessing.Pool(workers) if workers else None
+    swept = False
+    started = time.monotonic()
+    try:
+        for prefixes, failures in (pool.imap(decode_lines, chunks) if pool else map(decode_lines, chunks)):
+            in_flight.release()
+            if failures:
+                metrics.inc('parse_failures', failures)
+            for prefix_from_gobgp in prefixes:
+                writer.add(prefix_from_gobgp)
+            now = time.monotonic()
+            if not swept and (now - writer.last_stamped >= sweep_idle or now - started >= sweep_max_wait):
+                writer.sweep()
+                swept = True
+            if writer.time_left() == 0:
+                writer.flush()
+            else:
+                writer.tick()
+    finally:
+        if pool:
+            pool.terminate()
+    if not swept:
+        writer.sweep()
+    writer.flush(force=True)
+    writer.trim()
+    writer.report()
+    if writer.stats_interval:
+        writer.write_stats()
+    logging.info(f'RIB shadow memory: {rib.memory_usage() / 2**20:.1f} MiB')
+
+
+def positive_float(value):
+    """argparse type for a number of seconds that must be above zero."""
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f'must be positive, not {value}')
+    return number
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Pipe `gobgp monitor global rib -j` output into MongoDB.')
+    parser.add_argument('--host', default='mongodb', help='MongoDB host (default: %(default)s)')
+    parser.add_argument('--write-concern', type=lambda w: int(w) if w.isdigit() else w, default=WRITE_CONCERN,
+                        help='w for ingest writes: members to acknowledge, or majority (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='max prefixes per bulk write (default: %(default)s)')
+    parser.add_argument('--flush-interval', type=positive_float, default=FLUSH_INTERVAL,
+                        help='max seconds an update is buffered (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='processes decoding GoBGP output, 0 = decode inline (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='lines handed to a decoding process at a time (default: %(default)s)')
+    parser.add_argument('--coalesce-window', type=float, default=COALESCE_WINDOW,
+                        help='seconds to hold each prefix so update storms collapse into their final '
+                             'state, 0 = off (default: %(default)s)')
+    parser.add_argument('--sweep-idle', type=float, default=SWEEP_IDLE,
+                        help='idle seconds that end the initial table dump and retire routes '
+                             'it did not announce (default: %(default)s)')
+    parser.add_argument('--sweep-max-wait', type=float, default=SWEEP_MAX_WAIT,
+                        help='seconds after which the initial table dump is considered complete even if '
+                             'new prefixes are still arriving (default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve Prometheus metrics on this port, 0 = off (default: %(default)s)')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='seconds between writes of the ingest_stats document, 0 = off (default: %(default)s)')
+    parser.add_argument('--log-level', default='INFO', help='logging level (default: %(default)s)')
+    return parser.parse_args(args)
 
 
 def main():
-    db = db_connect()
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+    db = db_connect(args.host, args.write_concern)
     initialize_database(db)
-    for line in sys.stdin:
-        prefix_from_gobgp = build_json(get_update_entry(line))
-        prefix_from_database = db.bgp.find_one({'_id': prefix_from_gobgp['_id']})
-        if prefix_from_database:
-            updated_prefix = update_prefix(prefix_from_gobgp, prefix_from_database)
-            db.bgp.update({"_id": prefix_from_database['_id']}, updated_prefix, upsert=True)
-        else:
-            db.bgp.update({"_id": prefix_from_gobgp['_id']}, prefix_from_gobgp, upsert=True)
+    rib = RibShadow()
+    rib.load(db)
+    generation = next_generation(db)
+    logging.info(f'Ingest generation {generation}')
+    metrics = IngestMetrics()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    writer = BatchWriter(db, rib, generation, args.batch_size, args.flush_interval, args.coalesce_window,
+                         stats_interval=args.stats_interval, metrics=metrics)
+    ingest(db, rib, sys.stdin, generation, args.batch_size, args.flush_interval, args.workers,
+           args.chunk_size, args.sweep_idle, args.coalesce_window, writer=writer,
+           sweep_max_wait=args.sweep_max_wait)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+PREFIX = 'gobgp_to_mongo'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNTERS = {  # name -> help text
+    'lines_read': 'Lines read from GoBGP',
+    'parse_failures': 'Lines that did not decode to an update',
+    'updates': 'Updates passed to the writer',
+    'withdrawals': 'Updates that withdraw a prefix',
+    'flaps': 'Changes of attributes or announced/withdrawn state',
+    'writes': 'bgp documents written',
+    'history_appends': 'bgp_history entries inserted',
+    'flushes': 'Batches written',
+}
+GAUGES = {
+    'pending_prefixes': 'Prefixes waiting in the writer',
+    'rib_routes': 'Routes in the RIB shadow',
+    'flapping_prefixes': 'Prefixes with a flap penalty',
+    'damped_prefixes': 'Prefixes over the damping suppress limit',
+    'route_age_lag_seconds': 'Wall clock minus the age of the newest route written',
+    'generation': 'Ingest session generation',
+}
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed bucket bounds, as Prometheus expects."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class IngestMetrics(object):
+    """Counters, gauges and Mongo latency histograms for the ingester."""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.gauges = {}
+        self.latency = {}  # Mongo operation -> Histogram
+        self.started = time.time()
+        self.lock = threading.Lock()  # render() runs on the HTTP thread
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    @contextmanager
+    def timer(self, operation):
+        """Time a Mongo *operation* into its latency histogram."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.latency.setdefault(operation, Histogram()).observe(elapsed)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, help_text in COUNTERS.items():
+            lines += [f'# HELP {PREFIX}_{name}_total {help_text}',
+                      f'# TYPE {PREFIX}_{name}_total counter',
+                      f'{PREFIX}_{name}_total {self.counters[name]}']
+        for name, help_text in GAUGES.items():
+            if name in self.gauges:
+                lines += [f'# HELP {PREFIX}_{name} {help_text}',
+                          f'# TYPE {PREFIX}_{name} gauge',
+                          f'{PREFIX}_{name} {self.gauges[name]}']
+        lines += [f'# HELP {PREFIX}_mongo_operation_seconds Mongo operation latency',
+                  f'# TYPE {PREFIX}_mongo_operation_seconds histogram']
+        with self.lock:
+            for operation, histogram in sorted(self.latency.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{PREFIX}_mongo_operation_seconds_bucket{{operation="{operation}",le="{bound}"}} {count}')
+                lines += [f'{PREFIX}_mongo_operation_seconds_bucket{{operation="{operation}",le="+Inf"}} {histogram.count}',
+                          f'{PREFIX}_mongo_operation_seconds_sum{{operation="{operation}"}} {histogram.sum:.6f}',
+                          f'{PREFIX}_mongo_operation_seconds_count{{operation="{operation}"}} {histogram.count}']
+        lines.append(f'{PREFIX}_start_time_seconds {self.started:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def document(self):
+        """Return the metrics as a document for the ingest_stats collection."""
+        elapsed = max(time.time() - self.started, 1e-9)
+        with self.lock:
+            latency = {operation: {'count': histogram.count,
+                                   'avg_ms': round(histogram.sum / max(histogram.count, 1) * 1e3, 3)}
+                       for operation, histogram in self.latency.items()}
+        return {'_id': 'ingester',
+                'updated': datetime.now(timezone.utc),
+                'started': datetime.fromtimestamp(self.started, timezone.utc),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'updates_per_second': round(self.counters['updates'] / elapsed, 1),
+                'mongo_latency': latency}
+
+    def serve(self, port):
+        """Serve render() at http://0.0.0.0:*port*/metrics from a daemon thread."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f'Serving metrics on :{port}/metrics')
+        return server
@@ -0,0 +1,126 @@
+import sys
+import hashlib
+import logging
+import marshal
+from operator import itemgetter
+
+# Route fields kept in memory, in tuple order.
+ROUTE_FIELDS = ('ip_version', 'origin_asn', 'nexthop', 'nexthop_asn', 'as_path', 'med',
+                'local_pref', 'communities', 'route_origin', 'atomic_aggregate', 'aggregator_as',
+                'aggregator_address', 'originator_id', 'cluster_list', 'withdrawal', 'age', 'active',
+                'fingerprint', 'generation')
+WITHDRAWAL = ROUTE_FIELDS.index('withdrawal')
+ACTIVE = ROUTE_FIELDS.index('active')
+FINGERPRINT = ROUTE_FIELDS.index('fingerprint')
+GENERATION = ROUTE_FIELDS.index('generation')
+LIST_FIELDS = frozenset(('as_path', 'communities', 'cluster_list'))
+INTERNED_FIELDS = frozenset(('nexthop', 'as_path', 'communities', 'route_origin', 'aggregator_address',
+                             'originator_id', 'cluster_list'))
+
+# Path attributes covered by a route fingerprint; *age* and *active* are not.
+FINGERPRINT_FIELDS = ('origin_asn', 'nexthop', 'nexthop_asn', 'as_path', 'med', 'local_pref',
+                      'communities', 'route_origin', 'atomic_aggregate', 'aggregator_as',
+                      'aggregator_address', 'originator_id', 'cluster_list', 'withdrawal')
+_fingerprint_attributes = itemgetter(*FINGERPRINT_FIELDS)
+
+
+def route_fingerprint(prefix):
+    """Return a 64bit fingerprint of the path attributes of *prefix*.  It is
+    stored with the route, so it has to be stable across processes (unlike
+    hash()) and fit in a signed Mongo long.  The attributes are hashed in
+    marshal format 0, a compact typed binary encoding without the object
+    references of later formats, so equal values always encode alike and it
+    costs a fraction of repr().  List attributes must be lists, as they are
+    in build_json() output, Mongo documents and RibShadow.get()."""
+    attributes = marshal.dumps(_fingerprint_attributes(prefix), 0)
+    return int.from_bytes(hashlib.blake2b(attributes, digest_size=8).digest(), 'big', signed=True)
+
+
+class RibShadow(object):
+    """In-memory copy of the routes the ingester has written to Mongo, keyed by
+    prefix.  Each route is one tuple of ROUTE_FIELDS.  AS paths, communities,
+    cluster lists and next hops are shared between routes through an intern
+    table, since a full table has far fewer distinct values than prefixes."""
+
+    def __init__(self):
+        self.routes = {}
+        self.interned = {}
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, _id):
+        return _id in self.routes
+
+    def intern(self, value):
+        """Return the shared instance of *value*, storing it on first use."""
+        if isinstance(value, list):
+            value = tuple(value)
+        return self.interned.setdefault(value, value)
+
+    def load(self, db, batch_size=10000):
+        """Stream every route from the bgp collection into memory.  Stored
+        fingerprints are recomputed, since they may come from an older
+        encoding, and a mismatch would make every route look changed."""
+        for prefix in db.bgp.find({}, batch_size=batch_size):
+            prefix['fingerprint'] = route_fingerprint(prefix)
+            self.set(prefix)
+        logging.info(f'Loaded {len(self)} routes into the RIB shadow ({self.memory_usage() / 2**20:.1f} MiB)')
+
+    def set(self, prefix):
+        """Record *prefix* as written to the database."""
+        if prefix.get('fingerprint') is None:  # written before fingerprints existed
+            prefix['fingerprint'] = route_fingerprint(prefix)
+        prefix.setdefault('generation', 0)
+        self.routes[prefix['_id']] = tuple(self.intern(prefix[field]) if field in INTERNED_FIELDS
+                                           else prefix[field]
+                                           for field in ROUTE_FIELDS)
+
+    def get(self, _id):
+        """Return the stored route for *_id* as a prefix dict, or None if the
+        prefix has never been written."""
+        route = self.routes.get(_id)
+        if route is None:
+            return None
+        prefix = {'_id': _id}
+        for field, value in zip(ROUTE_FIELDS, route):
+            prefix[field] = list(value) if field in LIST_FIELDS else value
+        return prefix
+
+    def state(self, _id):
+        """Return (fingerprint, withdrawal) of the stored route for *_id*, or
+        None, without building a prefix dict."""
+        route = self.routes.get(_id)
+        if route is None:
+            return None
+        return route[FINGERPRINT], route[WITHDRAWAL]
+
+    def generation(self, _id):
+        """Return the generation that last wrote *_id*, or None."""
+        route = self.routes.get(_id)
+        return None if route is None else route[GENERATION]
+
+    def stale(self, generation):
+        """Return the active prefixes last written before *generation*."""
+        return [_id for _id, route in self.routes.items()
+                if route[ACTIVE] and route[GENERATION] < generation]
+
+    def deactivate(self, prefixes):
+        """Mark *prefixes* inactive, as a sweep did in the database."""
+        for _id in prefixes:
+            route = self.routes[_id]
+            self.routes[_id] = route[:ACTIVE] + (False,) + route[ACTIVE + 1:]
+
+    def memory_usage(self):
+        """Return an estimate in bytes of the memory held by the shadow."""
+        size = sys.getsizeof(self.routes) + sys.getsizeof(self.interned)
+        for _id, route in self.routes.items():
+            size += sys.getsizeof(_id) + sys.getsizeof(route)
+            for field, value in zip(ROUTE_FIELDS, route):
+                if field not in INTERNED_FIELDS and value is not None and not isinstance(value, bool):
+                    size += sys.getsizeof(value)
+        for value in self.interned:  # shared values are counted once
+            size += sys.getsizeof(value)
+            if isinstance(value, tuple):
+                size += sum(sys.getsizeof(item) for item in value)
+        return size
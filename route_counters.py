@@ -0,0 +1,106 @@
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+from operator import itemgetter
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from rib_shadow import ROUTE_FIELDS
+
+# Route fields a counter is derived from, in route_counts() argument order.
+COUNTED_FIELDS = ('ip_version', 'origin_asn', 'nexthop', 'nexthop_asn', 'as_path', 'communities', 'active')
+_counted_fields = itemgetter(*COUNTED_FIELDS)
+_counted_route = itemgetter(*(ROUTE_FIELDS.index(field) for field in COUNTED_FIELDS))
+RECONCILED = 'reconciled'  # _id of the document recording the last reconciliation
+
+
+def counter_id(kind, value, ip_version):
+    if isinstance(value, tuple):  # downstream counters count (next-hop ASN, downstream ASN) pairs
+        value = ':'.join(str(item) for item in value)
+    return f'{kind}:{value}:{ip_version}'
+
+
+def route_counts(_id, ip_version, origin_asn, nexthop, nexthop_asn, as_path, communities, active):
+    """Return the (kind, value, ip_version) counters an active route adds to,
+    with the amount.  Inactive routes count towards nothing."""
+    if not active:
+        return ()
+    counts = [(('version', ip_version, ip_version), 1),
+              (('mask', int(_id.rsplit('/', 1)[1]), ip_version), 1),
+              (('origin_asn', origin_asn, ip_version), 1),
+              (('nexthop_asn', nexthop_asn, ip_version), 1),
+              (('nexthop', nexthop, ip_version), 1),
+              (('as_path_length', None, ip_version), len(set(as_path)))]  # sets remove ASN prepending
+    counts.extend((('community', community, ip_version), 1) for community in set(communities) if community)
+    if len(as_path) > 1:  # the ASN behind the peer, for downstream ASNs per next-hop ASN
+        counts.append((('downstream', (nexthop_asn, as_path[1]), ip_version), 1))
+    return counts
+
+
+class RouteCounters(object):
+    """Prefix counts the dashboard reads from the bgp_counters collection:
+    prefixes per IP version, mask length, origin ASN, next-hop ASN, next hop,
+    community and (next-hop ASN, downstream ASN) pair, and the sum of AS path
+    lengths, each split by IP version.
+
+    The ingester records every route it writes with change(), and write()
+    sends the accumulated deltas as $inc updates.  reconcile() rebuilds every
+    counter from the RIB shadow, correcting any drift."""
+
+    def __init__(self):
+        self.deltas = Counter()
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def change(self, old, new):
+        """Record that route *old* (a prefix dict, or None) was replaced by *new*."""
+        if old is not None:
+            for key, amount in route_counts(old['_id'], *_counted_fields(old)):
+                self.deltas[key] -= amount
+        if new is not None:
+            for key, amount in route_counts(new['_id'], *_counted_fields(new)):
+                self.deltas[key] += amount
+
+    def deactivate(self, rib, prefixes):
+        """Record that *prefixes* in the RIB shadow are being deactivated."""
+        for _id in prefixes:
+            for key, amount in route_counts(_id, *_counted_route(rib.routes[_id])):
+                self.deltas[key] -= amount
+
+    def write(self, db):
+        """$inc the bgp_counters documents by the recorded deltas."""
+        requests = [UpdateOne({'_id': counter_id(*key)},
+                              {'$inc': {'count': amount},
+                               '$setOnInsert': {'kind': key[0], 'value': key[1], 'ip_version': key[2]}},
+                              upsert=True)
+                    for key, amount in self.deltas.items() if amount]
+        if requests:
+            db.bgp_counters.bulk_write(requests, ordered=False)
+        self.deltas = Counter()
+        return len(requests)
+
+    def reconcile(self, db, rib):
+        """Recount every counter from *rib* and correct the bgp_counters
+        documents that differ, deleting those that reached zero.  Pending
+        deltas are written first, since the RIB shadow already includes them.
+        Return the number of counters that had drifted."""
+        self.write(db)
+        counts = Counter()
+        for _id, route in rib.routes.items():
+            for key, amount in route_counts(_id, *_counted_route(route)):
+                counts[key] += amount
+        counts = {counter_id(*key): (key, amount) for key, amount in counts.items() if amount}
+        stored = {document['_id']: document['count'] for document in db.bgp_counters.find({'kind': {'$exists': True}},
+                                                                                          {'count': 1})}
+        requests = [ReplaceOne({'_id': _id}, {'_id': _id, 'kind': key[0], 'value': key[1], 'ip_version': key[2],
+                                              'count': amount}, upsert=True)
+                    for _id, (key, amount) in counts.items() if stored.get(_id) != amount]
+        corrected = len(requests) + sum(1 for _id, count in stored.items() if _id not in counts and count)
+        requests.extend(DeleteOne({'_id': _id}) for _id in stored if _id not in counts)  # zeroed counters too
+        if requests:
+            db.bgp_counters.bulk_write(requests, ordered=False)
+        db.bgp_counters.replace_one({'_id': RECONCILED}, {'_id': RECONCILED, 'timestamp': datetime.now(timezone.utc),
+                                                          'counters': len(counts), 'corrected': corrected},
+                                    upsert=True)
+        if stored and corrected:
+            logging.warning(f'Reconciled bgp_counters: corrected {corrected} of {len(counts)} counters')
+        return corrected